@@ -1,3 +1,4 @@
 from ctns.contact_network_simulator import main
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
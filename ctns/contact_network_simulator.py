@@ -1,15 +1,64 @@
 import numpy as np
-from pathlib import Path
-from collections import deque, Counter
-import sys, random, time, pickle
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import time, os
 try:
-    from ctns.generator import generate_network, init_infection, compute_TR
+    from ctns.generator import generate_network, cached_generate_network, init_infection, compute_TR
     from ctns.steps import step
-    from ctns.utility import update_dump_report
+    from ctns.utility import update_dump_report, pack_network, dump_record, snapshot_contacts, open_dump, finalize_dump, create_generators, init_dump_report, trim_dump_report, \
+        encode_status, STATUS_LABELS, EXPOSED, INFECTIVE
+    from ctns.validate import validate_parameters
 except ImportError as e:
-    from generator import generate_network, init_infection, compute_TR
+    from generator import generate_network, cached_generate_network, init_infection, compute_TR
     from steps import step
-    from utility import update_dump_report
+    from utility import update_dump_report, pack_network, dump_record, snapshot_contacts, open_dump, finalize_dump, create_generators, init_dump_report, trim_dump_report, \
+        encode_status, STATUS_LABELS, EXPOSED, INFECTIVE
+    from validate import validate_parameters
+
+def _record_step(net, sim_index, new_positive_counter, nets, to_dump, dump_file, dump_type, use_probabilities):
+    """
+    Record the result of a simulation step in the contact history and in the dump
+    
+    Parameters
+    ----------
+    net: ig.Graph()
+        The contact network after the step
+
+    sim_index: int
+        Index of the step
+
+    new_positive_counter: int
+        Number of new positive nodes found on this step
+
+    nets: deque of dict
+        History of the contacts, see snapshot_contacts
+
+    to_dump: dict
+        The simulation dump
+
+    dump_file: file
+        File where the networks are written if dump_type is full, None otherwise
+
+    dump_type: string
+        Can be either ["full", "light"]
+
+    use_probabilities: bool
+        Enables probabilities of being infected estimation
+
+    Return
+    ------
+    None
+
+    """
+
+    # with contact tracing disabled the history has length 0, skip the snapshot
+    if nets.maxlen:
+        nets.append(snapshot_contacts(net))
+    if dump_type == "full":
+        dump_record(pack_network(net), dump_file)
+    if dump_type == "light":
+        update_dump_report(to_dump, sim_index, net, new_positive_counter, use_probabilities)
 
 def run_simulation(n_of_families = 250,
     use_steps = True,
@@ -34,7 +83,10 @@ def run_simulation(n_of_families = 250,
     gamma = 0.003,
     lambdaa = 0.02,
     dump_type = None,
-    path = None):
+    path = None,
+    compress_dump = False,
+    cache_network = False,
+    betweenness_cutoff = None):
     """
     Execute the simulation and dump/return resulting networks
 
@@ -113,91 +165,46 @@ def run_simulation(n_of_families = 250,
         Otherwise, only a report about node status is saved.
         NB, full method will use significally more RAM than light; also the dump will have much bigger size.
         The dumped file will have the following structure:
-        - a dict containig simulation parameters and a list of ig.Graph() if dump_type is full
-        - a dict[class] where class can be [S, E, I, R, D, quarantined, positive, tested, total] and value is a list of the corresponding attribute value on day i
+        - a dict containig simulation parameters followed by one ig.Graph() per day if dump_type is full.
+          Networks are streamed to the file while the simulation runs, use load_dump to read them back
+        - a dict[class] where class can be [S, E, I, R, D, quarantined, positive, tested, total] and value is a NumPy array of the corresponding attribute value on day i
 
     path: string
         The path to the file/folder where the networks will be saved
 
+    compress_dump: bool
+        Compress the dump with zstd, the file type will be .pickle.zst. Requires the zstandard package
+
+    cache_network: bool
+        Store the generated network on disk (see generator.network_cache_dir) and reuse it in the
+        following runs with the same n_of_families and seed. Ignored if use_fixed_seed is False
+
+    betweenness_cutoff: float
+        Only paths up to this length (sum of the contact weights) are counted by the Betweenness Centrality policy.
+        The centrality is approximated, but much faster to compute on large networks. None counts all the paths
+
     Return
     ------
-    None
+    to_dump: dict
+        The dumped data. In case of full dump, the networks are only written to the file
+
+    Raise
+    -----
+    ValueError
+        If a parameter has an invalid value
 
     """
 
-    # generate new edges
-    if use_fixed_seed:
-        np.random.seed(seed = seed)
-        random.seed(seed)
-    else:
-        np.random.seed(int(time.time()))
-        random.seed(time.time())
-    
     # check values
-    if n_of_families < 10:
-        print("Invalid number of families. Use at least 10 families")
-        sys.exit()
-    if use_steps:
-        if number_of_steps < 0:
-            print("Invalid number of steps")
-            sys.exit()
-    if infection_duration < 0:
-        print("Invalid infection duration")
-        sys.exit()
-    if incubation_days < 0 or incubation_days >= infection_duration:
-        print("Invalid incubation duration")
-        sys.exit()
-    if initial_day_restriction < 0 :
-        print("Invalid initial day social distancing")
-        sys.exit()
-    if social_distance_strictness < 0 or social_distance_strictness > 4:
-        print("Invalid social distancing value")
-        sys.exit()
-    if n_initial_infected_nodes < 0 or n_initial_infected_nodes > n_of_families:
-        print("Invalid number of initial infected nodes")
-        sys.exit()
-    if R_0 < 0:
-        print("Invalid value of R0")
-        sys.exit()
-    if n_test < 0:
-        print("Invalid number of test per day")
-        sys.exit()
-    if not (policy_test == "Random" or policy_test == "Degree Centrality" or policy_test == "Betweenness Centrality" or "PBI"):
-        print("Invalid test strategy")
-        sys.exit()
-    if contact_tracing_efficiency < 0 or contact_tracing_efficiency > 1:
-        print("Invalid contact tracing efficiency")
-        sys.exit()
-    if quarantine_efficiency < 0 or quarantine_efficiency > 1:
-        print("Invalid quarantine efficiency")
-        sys.exit()
-    if contact_tracing_duration < 0:
-        print("Invalid contatc tracing duration")
-        sys.exit()
-    if restriction_duration < 0:
-        print("Invalid restriction restriction_duration")
-        sys.exit()
-    if restriction_duration == 0:
-        restriction_decreasing = False
-        social_distance_strictness = 0
-    if social_distance_strictness == 0:
-        restriction_decreasing = False
-        restriction_duration = 0
-    if gamma < 0 :
-        print("Value of gamma must greater than 0")
-        sys.exit()
-    if lambdaa < 0 or lambdaa > 1:
-        print("Value of lambda must be 0 < lambda < 1")
-        sys.exit()
-    if dump_type != "full" and dump_type != "light":
-        print("Invalid dump type")
-        sys.exit()
-    if path == None:
-        print("Invalid path")
-        sys.exit()
-    if not use_probabilities and policy_test == "PBI":
-        print("Cannot use PBI if probability of being infected is not enabled")
-        sys.exit()
+    validate_parameters(n_of_families = n_of_families, use_steps = use_steps, number_of_steps = number_of_steps,
+        incubation_days = incubation_days, infection_duration = infection_duration,
+        initial_day_restriction = initial_day_restriction, restriction_duration = restriction_duration,
+        social_distance_strictness = social_distance_strictness, restriction_decreasing = restriction_decreasing,
+        n_initial_infected_nodes = n_initial_infected_nodes, R_0 = R_0, n_test = n_test, policy_test = policy_test,
+        contact_tracing_efficiency = contact_tracing_efficiency, contact_tracing_duration = contact_tracing_duration,
+        quarantine_efficiency = quarantine_efficiency, use_fixed_seed = use_fixed_seed, seed = seed,
+        use_probabilities = use_probabilities, alpha = alpha, gamma = gamma, lambdaa = lambdaa,
+        dump_type = dump_type, path = path, compress_dump = compress_dump, betweenness_cutoff = betweenness_cutoff)
 
     # making parameters consistent
     if restriction_duration == 0 or social_distance_strictness == 0:
@@ -206,6 +213,9 @@ def run_simulation(n_of_families = 250,
         initial_day_restriction = 0
         restriction_duration = 0
 
+    if policy_test != "Betweenness Centrality":
+        betweenness_cutoff = None
+
     if n_test == 0:
         policy_test = None
         contact_tracing_efficiency = 0
@@ -220,76 +230,237 @@ def run_simulation(n_of_families = 250,
         lambdaa = 0
 
     config = locals()
+
+    # each simulation owns its random generators, so runs can be executed in parallel
+    if use_fixed_seed:
+        seed_sequence = np.random.SeedSequence(seed)
+        tr_cache_key = (n_of_families, seed)
+    else:
+        seed_sequence = np.random.SeedSequence()
+        tr_cache_key = None
+    # the network and the transmission rate estimate draw from their own streams, so caching them leaves the simulation unchanged
+    simulation_seed, tr_seed, network_seed = seed_sequence.spawn(3)
+    rng, pyrng = create_generators(simulation_seed)
+
     a = time.perf_counter()
     # init network
-    G = generate_network(n_of_families, use_probabilities)
-    transmission_rate = compute_TR(G, R_0, infection_duration, incubation_days)
-    init_infection(G, n_initial_infected_nodes)
+    if cache_network and use_fixed_seed:
+        G = cached_generate_network(n_of_families, use_probabilities, seed, network_seed)
+    else:
+        G = generate_network(n_of_families, use_probabilities, *create_generators(network_seed))
+    transmission_rate = compute_TR(G, R_0, infection_duration, incubation_days, create_generators(tr_seed)[0], cache_key = tr_cache_key)
+    init_infection(G, n_initial_infected_nodes, pyrng)
 
     nets = deque(maxlen = contact_tracing_duration)
+    dump_file = None
     if dump_type == "full":
         to_dump = dict()
-        to_dump["nets"] = list()
         to_dump["parameters"] = config
+        # nets are written one per day instead of being kept in RAM till the end
+        dump_file, tmp_path = open_dump(path, "wb", compress_dump)
     if dump_type == "light":
-        to_dump = dict()
-        to_dump['S'] = list()
-        to_dump['E'] = list()
-        to_dump['I'] = list()
-        to_dump['R'] = list()
-        to_dump['D'] = list()
-        to_dump['quarantined'] = list()
-        to_dump['positive'] = list()
-        to_dump['tested'] = list()
-        to_dump['total'] = list()
-        to_dump['new_positive_counter'] = list()
-        to_dump['avg_prob_inf'] = list()
+        # the length of an open-ended simulation is unknown, the series grow as needed
+        to_dump = init_dump_report(number_of_steps if use_steps else 256, use_probabilities)
         to_dump['parameters'] = config
 
-    if use_steps:
-        for sim_index in range (0, number_of_steps):
-            net, new_positive_counter = step(G, sim_index, incubation_days, infection_duration, transmission_rate,
-                             initial_day_restriction, restriction_duration, social_distance_strictness, 
-                             restriction_decreasing, nets, n_test, policy_test, contact_tracing_efficiency,
-                             quarantine_efficiency, use_probabilities, alpha, gamma, lambdaa)
-            nets.append(net.copy())
-            if dump_type == "full":
-                to_dump["nets"].append(net.copy())
-            if dump_type == "light":
-                to_dump = update_dump_report(to_dump, net, new_positive_counter, use_probabilities)
-    else:
-        exposed = n_initial_infected_nodes
-        infected = 0
-        sim_index = 0
-        while((infected + exposed) != 0):
-            net, new_positive_counter = step(G, sim_index, incubation_days, infection_duration, transmission_rate,
-                             initial_day_restriction, restriction_duration, social_distance_strictness, 
-                             restriction_decreasing, nets, n_test, policy_test, contact_tracing_efficiency,
-                             quarantine_efficiency, use_probabilities, alpha, gamma, lambdaa)
-            nets.append(net.copy())
-            sim_index += 1
-
-            if dump_type == "full":
-                to_dump["nets"].append(net.copy())
-            if dump_type == "light":
-                to_dump = update_dump_report(to_dump, net, new_positive_counter, use_probabilities)
-            
-            network_report = Counter(net.vs["agent_status"])
-            infected = network_report["I"]
-            exposed = network_report["E"]
-            if infected + exposed == 0:
-                break
-
-    with open(Path(path + ".pickle"), "wb") as f:
-        pickle.dump(to_dump, f, protocol = pickle.DEFAULT_PROTOCOL)
+    # local names are resolved faster than globals inside the simulation loops
+    _step = step
+    _record = _record_step
+
+    completed = False
+    try:
+        if dump_type == "full":
+            dump_record(to_dump, dump_file)
+        if use_steps:
+            for sim_index in range (0, number_of_steps):
+                net, new_positive_counter = _step(G, sim_index, incubation_days, infection_duration, transmission_rate,
+                                 initial_day_restriction, restriction_duration, social_distance_strictness, 
+                                 restriction_decreasing, nets, n_test, policy_test, contact_tracing_efficiency,
+                                 quarantine_efficiency, use_probabilities, alpha, gamma, lambdaa, rng, betweenness_cutoff)
+                _record(net, sim_index, new_positive_counter, nets, to_dump, dump_file, dump_type, use_probabilities)
+        else:
+            sim_index = 0
+            while True:
+                net, new_positive_counter = _step(G, sim_index, incubation_days, infection_duration, transmission_rate,
+                                 initial_day_restriction, restriction_duration, social_distance_strictness, 
+                                 restriction_decreasing, nets, n_test, policy_test, contact_tracing_efficiency,
+                                 quarantine_efficiency, use_probabilities, alpha, gamma, lambdaa, rng, betweenness_cutoff)
+                _record(net, sim_index, new_positive_counter, nets, to_dump, dump_file, dump_type, use_probabilities)
+                sim_index += 1
+
+                # the simulation ends when there are no more exposed or infective nodes
+                status_counts = np.bincount(encode_status(net.vs["agent_status"]), minlength = len(STATUS_LABELS))
+                if status_counts[INFECTIVE] + status_counts[EXPOSED] == 0:
+                    break
+        completed = True
+    finally:
+        # a failed simulation leaves no partial dump, the dump of a previous run is untouched
+        if dump_file is not None:
+            dump_file.close()
+            if not completed:
+                os.remove(tmp_path)
+
+    if dump_type == "full":
+        finalize_dump(tmp_path, path, compress_dump)
+    if dump_type == "light":
+        if not use_steps:
+            trim_dump_report(to_dump, sim_index)
+        dump_file, tmp_path = open_dump(path, "wb", compress_dump)
+        with dump_file as f:
+            dump_record(to_dump, f)
+        finalize_dump(tmp_path, path, compress_dump)
     b = time.perf_counter()
     print("\n Simulation ended successfully \n")
     print("time elapsed " + str(b-a))
 
-def main():
+    return to_dump
+
+def _run_replicate(parameters):
+    """
+    Run a single replicate of run_replicates in a worker process
+    
+    Parameters
+    ----------
+    parameters: dict
+        Arguments of run_simulation
+
+    Return
+    ------
+    to_dump: dict
+        The dumped data of the replicate
+
+    """
+
+    return run_simulation(**parameters)
+
+def run_replicates(n_replicates, seed = 42, path = None, max_workers = None, use_fixed_seed = True, **kwargs):
+    """
+    Execute independent replicates of the same simulation in parallel, one per process.
+    Replicate i uses seed + i as random seed and is dumped in path_i
+    When using this function from a script, call it under if __name__ == "__main__"
+
+    Parameters
+    ----------
+    n_replicates: int
+        Number of replicates to run
+
+    seed: int
+        Random seed of the first replicate
+
+    path: string
+        The path to the file/folder where the networks will be saved. The index of the replicate is appended
+
+    max_workers: int
+        Number of worker processes, by default the number of CPUs
+
+    use_fixed_seed: bool
+        Use seed, or draw the seed of the first replicate at random.
+        Replicates are always seeded, the seed of each one is stored in its dump parameters
+
+    kwargs:
+        Other arguments of run_simulation
+
+    Return
+    ------
+    dumps: list of dict
+        The dumped data of each replicate, see run_simulation
+
+    Raise
+    -----
+    ValueError
+        If a parameter has an invalid value
+
+    """
+
+    if path == None:
+        raise ValueError("Invalid path")
+
+    if not use_fixed_seed:
+        seed = int(np.random.SeedSequence().generate_state(1)[0])
+
+    replicates = list()
+    for i in range(n_replicates):
+        replicates.append(dict(kwargs, use_fixed_seed = True, seed = seed + i, path = path + "_" + str(i)))
+
+    with ProcessPoolExecutor(max_workers = max_workers) as executor:
+        return list(executor.map(_run_replicate, replicates))
+
+def run_sweep(configurations, n_replicates = 1, seed = 42, path = None, max_workers = None, use_fixed_seed = True, **kwargs):
+    """
+    Execute the simulations of several parameter configurations in parallel, one per process.
+    Replicate j of every configuration uses seed + j as random seed, so configurations are compared on the same networks,
+    and configuration i is dumped in path_i_j
+    When using this function from a script, call it under if __name__ == "__main__"
+
+    Parameters
+    ----------
+    configurations: list of dict
+        Arguments of run_simulation that change between configurations. seed, use_fixed_seed and path
+        are set by run_sweep and cannot appear in a configuration
+
+    n_replicates: int
+        Number of replicates of each configuration
+
+    seed: int
+        Random seed of the first replicate
+
+    path: string
+        The path to the file/folder where the networks will be saved. The index of configuration and replicate is appended
+
+    max_workers: int
+        Number of worker processes, by default the number of CPUs
+
+    use_fixed_seed: bool
+        Use seed, or draw the seed of the first replicate at random.
+        Runs are always seeded, the seed of each one is stored in its dump parameters
+
+    kwargs:
+        Arguments of run_simulation shared by all the configurations
+
+    Return
+    ------
+    dumps: list of list of dict
+        The dumped data of each replicate of each configuration, see run_simulation
+
+    Raise
+    -----
+    ValueError
+        If a parameter has an invalid value
+
+    """
+
+    if path == None:
+        raise ValueError("Invalid path")
+    for configuration in configurations:
+        reserved = sorted({"seed", "use_fixed_seed", "path"} & configuration.keys())
+        if reserved:
+            raise ValueError("Invalid configuration, " + ", ".join(reserved) + " must be given to run_sweep")
+
+    if not use_fixed_seed:
+        seed = int(np.random.SeedSequence().generate_state(1)[0])
+
+    runs = list()
+    for i, configuration in enumerate(configurations):
+        for j in range(n_replicates):
+            runs.append(dict(kwargs, **configuration, use_fixed_seed = True, seed = seed + j,
+                             path = path + "_" + str(i) + "_" + str(j)))
+
+    # a single pool for all the runs keeps every worker busy until the whole sweep is over
+    with ProcessPoolExecutor(max_workers = max_workers) as executor:
+        dumps = list(executor.map(_run_replicate, runs))
+
+    return [dumps[i * n_replicates:(i + 1) * n_replicates] for i in range(len(configurations))]
+
+def _interactive_main():
 
     dump_type = None
     path = None
+    # values not asked to the user keep the run_simulation defaults
+    number_of_steps = 150
+    seed = 42
+    alpha = 0.5
+    gamma = 0.003
+    lambdaa = 0.02
 
     user_interaction = int(input("Press 0 to load the default values or 1 to manually input the configuration for the simulation: "))
     # get values from user
@@ -322,14 +493,70 @@ def main():
         dump_type = input("Please insert the dump type. Can be either full of light: ")
         path = input("Please insert the path with the file to dump. Please omit file type, that will be set automatically: ")
 
-        run_simulation(n_of_families, use_steps, number_of_steps, incubation_days, infection_duration,
-            initial_day_restriction, restriction_duration, social_distance_strictness, restriction_decreasing,
-            n_initial_infected_nodes, R_0, n_test, policy_test, contact_tracing_efficiency, contact_tracing_duration,
-            quarantine_efficiency, use_fixed_seed, seed, use_probabilities, alpha, gamma, lambdaa, dump_type, path)
+        try:
+            run_simulation(n_of_families, use_steps, number_of_steps, incubation_days, infection_duration,
+                initial_day_restriction, restriction_duration, social_distance_strictness, restriction_decreasing,
+                n_initial_infected_nodes, R_0, n_test, policy_test, contact_tracing_efficiency, contact_tracing_duration,
+                quarantine_efficiency, use_fixed_seed, seed, use_probabilities, alpha, gamma, lambdaa, dump_type, path)
+        except ValueError as e:
+            print(e)
     else:
         dump_type = input("Please insert the dump type. Can be either full of light: ")
         path = input("Please insert the path with the file to dump. Please omit file type, that will be set automatically: ")
-        run_simulation(path = path, dump_type = dump_type)
+        try:
+            run_simulation(path = path, dump_type = dump_type)
+        except ValueError as e:
+            print(e)
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "CTNS, Contact Tracing Network Simulator")
+    parser.add_argument("--interactive", action = "store_true", help = "ask the configuration of the simulation on the terminal")
+    parser.add_argument("--n-of-families", type = int, default = 250, help = "number of families in the network")
+    parser.add_argument("--no-steps", dest = "use_steps", action = "store_false", help = "run the simulation untill the infection is over")
+    parser.add_argument("--number-of-steps", type = int, default = 150, help = "number of simulation steps")
+    parser.add_argument("--incubation-days", type = int, default = 5, help = "disease incubation duration")
+    parser.add_argument("--infection-duration", type = int, default = 21, help = "disease duration")
+    parser.add_argument("--initial-day-restriction", type = int, default = 50, help = "step index from which the social distance is applied")
+    parser.add_argument("--restriction-duration", type = int, default = 21, help = "number of days which the social distance last, 0 to make it last for all the simulation")
+    parser.add_argument("--social-distance-strictness", type = int, default = 2, help = "social distance strictness, from 0 to 4")
+    parser.add_argument("--no-restriction-decreasing", dest = "restriction_decreasing", action = "store_false", help = "keep the strictness of the social distance fixed")
+    parser.add_argument("--n-initial-infected-nodes", type = int, default = 3, help = "number of initial infected individuals")
+    parser.add_argument("--R-0", dest = "R_0", type = float, default = 2.9, help = "R0 of the disease")
+    parser.add_argument("--n-test", type = int, default = 3, help = "number of available tests per day")
+    parser.add_argument("--policy-test", default = "Random", choices = ["Random", "Degree Centrality", "Betweenness Centrality", "PBI"], help = "strategy with which tests are made")
+    parser.add_argument("--contact-tracing-efficiency", type = float, default = 0.8, help = "contact tracing efficiency, between 0 and 1")
+    parser.add_argument("--contact-tracing-duration", type = int, default = 14, help = "number of days the contact tracing is computed for")
+    parser.add_argument("--quarantine-efficiency", type = float, default = 0.4, help = "quarantine efficiency, between 0 and 1")
+    parser.add_argument("--random-seed", dest = "use_fixed_seed", action = "store_false", help = "pick a random seed instead of a fixed one")
+    parser.add_argument("--seed", type = int, default = 42, help = "the random seed")
+    parser.add_argument("--use-probabilities", action = "store_true", help = "enable estimation of probabilities of being infected")
+    parser.add_argument("--alpha", type = float, default = 0.5, help = "probability of being infected contact decay")
+    parser.add_argument("--gamma", type = float, default = 0.003, help = "probability of being infected contact diffusion")
+    parser.add_argument("--lambdaa", type = float, default = 0.02, help = "influence of contacts with a positive")
+    parser.add_argument("--dump-type", choices = ["full", "light"], help = "dump type")
+    parser.add_argument("--path", help = "path of the file to dump, without file type")
+    parser.add_argument("--compress-dump", action = "store_true", help = "compress the dump with zstd")
+    parser.add_argument("--cache-network", action = "store_true", help = "reuse the network generated by previous runs with the same seed")
+    parser.add_argument("--betweenness-cutoff", type = float, help = "maximum length of the paths counted by the Betweenness Centrality policy")
+    parser.add_argument("--replicates", type = int, default = 1, help = "number of independent replicates, run in parallel with seeds seed, seed + 1, ...")
+    parser.add_argument("--workers", type = int, help = "number of worker processes for the replicates, by default the number of CPUs")
+    args = vars(parser.parse_args())
+
+    if args.pop("interactive"):
+        _interactive_main()
+        return
+    if args["dump_type"] is None or args["path"] is None:
+        parser.error("--dump-type and --path are required, unless --interactive is used")
+    n_replicates = args.pop("replicates")
+    max_workers = args.pop("workers")
+    try:
+        if n_replicates > 1:
+            run_replicates(n_replicates, max_workers = max_workers, **args)
+        else:
+            run_simulation(**args)
+    except ValueError as e:
+        print(e)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
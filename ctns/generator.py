@@ -1,14 +1,59 @@
 import igraph as ig
-import random, math
+import math, os
 import numpy as np
+from pathlib import Path
 try:
-    from ctns.utility import fix_distribution_node_number, reset_network
+    from ctns.utility import fix_distribution_node_number, reset_network, create_generators, pack_network, unpack_network, dump_record, load_record
     from ctns.steps import step
 except ImportError as e:
-    from utility import fix_distribution_node_number, reset_network
+    from utility import fix_distribution_node_number, reset_network, create_generators, pack_network, unpack_network, dump_record, load_record
     from steps import step
 
-def generate_node_list_attribute(G, attribute_name, distribution):
+# bump when generate_network changes, so that old cached networks are not used
+_NETWORK_CACHE_VERSION = 3
+
+# values of the node attributes with their probabilities
+SEX_DISTRIBUTION = (["man", "woman"], [0.487, 0.513])
+# age is the represented by the lower bound, so if age is 20, the person has age [20-29]
+AGE_DISTRIBUTION = ([0, 10, 20, 30, 40, 50, 60, 70, 80, 90],
+    [0.084, 0.096, 0.102, 0.117, 0.153, 0.155, 0.122, 0.099, 0.059, 0.013])
+ELDER_SOCIABILITY_DISTRIBUTION = (['low', 'medium', 'high'], [0.75, 0.23, 0.02])
+ELDER_CONDITIONS_DISTRIBUTION = ([0, 1, 2, 3], [0.1, 0.4, 0.3, 0.2])
+SOCIABILITY_DISTRIBUTION = (['low', 'medium', 'high'], [0.6, 0.3, 0.1])
+CONDITIONS_DISTRIBUTION = ([0, 1, 2, 3], [0.6, 0.2, 0.1, 0.1])
+
+def draw_value(distribution, rng):
+    """
+    Draw a value from a discrete distribution comparing a single uniform number
+    with the cumulative probabilities. For single draws this is much faster than rng.choice,
+    which validates and normalizes the probabilities on each call
+    
+    Parameters
+    ----------
+    distribution: tuple of list
+        The possible values and their probabilities
+
+    rng: np.random.Generator
+        Random number generator
+
+    Return
+    ------
+    value:
+        The drawn value
+
+    """
+
+    values, probabilities = distribution
+    u = rng.random()
+    cumulative = 0
+    for value, p in zip(values, probabilities):
+        cumulative += p
+        if u < cumulative:
+            return value
+    # rounding of the cumulative probabilities
+    return values[-1]
+
+def generate_node_list_attribute(G, attribute_name, distribution, pyrng):
     """
     Add to each node a list named attribute_name containing edge representing the
     possible social contanct to each node.
@@ -24,6 +69,9 @@ def generate_node_list_attribute(G, attribute_name, distribution):
 
     distribution: list of int
         Distribution of the "community" dimension
+
+    pyrng: random.Random
+        Python random number generator
         
     Return
     ------
@@ -31,9 +79,12 @@ def generate_node_list_attribute(G, attribute_name, distribution):
 
     """
 
+    # work on node indices and attribute lists, instead of a vertex proxy per node
+    sociability = G.vs["sociability"]
+    contacts = G.vs[attribute_name]
     # extract node list and randomize
-    node_list = list(G.vs)
-    random.shuffle(node_list)
+    node_list = list(range(G.vcount()))
+    pyrng.shuffle(node_list)
     # iterate over community
     for element in distribution:
         community_nodes = list()
@@ -45,18 +96,20 @@ def generate_node_list_attribute(G, attribute_name, distribution):
         for node in community_nodes:
             tmp = int(math.ceil(len(community_nodes) / 3))
             tmp2 = int(math.ceil(2 * len(community_nodes) / 3))
-            if node["sociability"] == "low":
-                n_contact = 1 + int(random.random() * (tmp - 1))
-            if node["sociability"] == "medium":
-                n_contact = tmp + int(random.random() * (tmp2 - tmp))
-            if node["sociability"] == "high":
-                n_contact = tmp2 + int(random.random() * (len(community_nodes) + 1 - tmp2))
-
-            targets = random.sample(community_nodes, n_contact)
+            if sociability[node] == "low":
+                n_contact = 1 + int(pyrng.random() * (tmp - 1))
+            if sociability[node] == "medium":
+                n_contact = tmp + int(pyrng.random() * (tmp2 - tmp))
+            if sociability[node] == "high":
+                n_contact = tmp2 + int(pyrng.random() * (len(community_nodes) + 1 - tmp2))
+
+            targets = pyrng.sample(community_nodes, n_contact)
             for target in targets:
-                if target != node and not (node.index, target.index) in node[attribute_name]:
-                    node[attribute_name].append((node.index, target.index))
-                    target[attribute_name].append((target.index, node.index))  
+                if target != node and not (node, target) in contacts[node]:
+                    contacts[node].append((node, target))
+                    contacts[target].append((target, node))
+
+    G.vs[attribute_name] = contacts
 
 def generate_node_family_attribute(G, distribution):
     """
@@ -88,7 +141,7 @@ def generate_node_family_attribute(G, distribution):
                 if source != target:
                     G.vs[source]["family_contacts"].append((source, target))  
 
-def generate_network(n_of_families, use_probabilities):
+def generate_network(n_of_families, use_probabilities, rng, pyrng):
     """
     Generte contact network nodes
     
@@ -99,6 +152,12 @@ def generate_network(n_of_families, use_probabilities):
 
     use_probabilities: bool
         Enables probabilities of being infected estimation
+
+    rng: np.random.Generator
+        Random number generator
+
+    pyrng: random.Random
+        Python random number generator
         
     Return
     ------
@@ -109,20 +168,20 @@ def generate_network(n_of_families, use_probabilities):
 
     #DISTRIBUTIONS
     # family distribution
-    family_distribution = np.random.normal(2, 2, n_of_families).round().astype(int)
+    family_distribution = rng.normal(2, 2, n_of_families).round().astype(int)
     family_distribution = [x if x > 1 else 1 for x in family_distribution]
 
     number_of_nodes = np.sum(family_distribution)
 
     # frequent contact distribution
-    frequent_contact_distribution = np.random.normal(12, 3, n_of_families).round().astype(int)
+    frequent_contact_distribution = rng.normal(12, 3, n_of_families).round().astype(int)
     frequent_contact_distribution = list(frequent_contact_distribution[frequent_contact_distribution >= 0])
 
     # refine to have sum = node number
     frequent_contact_distribution = fix_distribution_node_number(frequent_contact_distribution, number_of_nodes)
 
     # occasional contact distribution
-    occasional_contact_distribution = np.random.normal(24, 6, n_of_families).round().astype(int)
+    occasional_contact_distribution = rng.normal(24, 6, n_of_families).round().astype(int)
     occasional_contact_distribution = list(occasional_contact_distribution[occasional_contact_distribution >= 0])
 
     # refine to have sum = node number
@@ -134,10 +193,8 @@ def generate_network(n_of_families, use_probabilities):
     G = ig.Graph()
     G.add_vertices(number_of_nodes)
     for node in G.vs:
-        node["sex"] = np.random.choice(["man", "woman"], p = [0.487, 0.513])
-        # age is the represented by the lower bound, so if age is 20, the person has age [20-29]
-        node["age"] = np.random.choice([0, 10, 20, 30, 40, 50, 60, 70, 80, 90], 
-            p = [0.084, 0.096, 0.102, 0.117, 0.153, 0.155, 0.122, 0.099, 0.059, 0.013]) 
+        node["sex"] = draw_value(SEX_DISTRIBUTION, rng)
+        node["age"] = draw_value(AGE_DISTRIBUTION, rng)
 
         node["family_id"] = -1
         node["family_contacts"] = list()
@@ -149,15 +206,11 @@ def generate_network(n_of_families, use_probabilities):
             node["sociability"] = "low"
             node["pre_existing_conditions"] = 0
         elif node["age"] > 70:
-            node["sociability"] = np.random.choice(
-                ['low', 'medium', 'high'], p=[0.75, 0.23, 0.02])
-            node["pre_existing_conditions"] = np.random.choice(
-                [0, 1, 2, 3], p=[0.1, 0.4, 0.3, 0.2])
+            node["sociability"] = draw_value(ELDER_SOCIABILITY_DISTRIBUTION, rng)
+            node["pre_existing_conditions"] = draw_value(ELDER_CONDITIONS_DISTRIBUTION, rng)
         else:
-            node["sociability"] = np.random.choice(
-                ['low', 'medium', 'high'], p=[0.6, 0.3, 0.1])
-            node["pre_existing_conditions"] = np.random.choice(
-                [0, 1, 2, 3], p=[0.6, 0.2, 0.1, 0.1])
+            node["sociability"] = draw_value(SOCIABILITY_DISTRIBUTION, rng)
+            node["pre_existing_conditions"] = draw_value(CONDITIONS_DISTRIBUTION, rng)
         
         if node["age"] < 10:
             node["death_rate"] = 0.002
@@ -195,13 +248,69 @@ def generate_network(n_of_families, use_probabilities):
     # generate families contact attribute in nodes
     generate_node_family_attribute(G, family_distribution)
     # generate frequent contact attribute in nodes
-    generate_node_list_attribute(G, "frequent_contacts", frequent_contact_distribution)
+    generate_node_list_attribute(G, "frequent_contacts", frequent_contact_distribution, pyrng)
     # generate occasional contact attribute in nodes
-    generate_node_list_attribute(G, "occasional_contacts", occasional_contact_distribution)
+    generate_node_list_attribute(G, "occasional_contacts", occasional_contact_distribution, pyrng)
 
     return G  
 
-def init_infection(G, n_initial_infected_nodes):
+def network_cache_dir():
+    """
+    Folder where the generated networks are cached, $XDG_CACHE_HOME/ctns or ~/.cache/ctns
+    
+    Return
+    ------
+    path: Path
+        The cache folder
+
+    """
+
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "ctns"
+
+def cached_generate_network(n_of_families, use_probabilities, seed, seed_sequence):
+    """
+    Generte contact network nodes, reusing the network cached on disk by a previous
+    run with the same number of families and seed
+    
+    Parameters
+    ----------
+    n_of_families: int
+        Number of families in the network
+
+    use_probabilities: bool
+        Enables probabilities of being infected estimation
+
+    seed: int
+        The random seed of the simulation, used as cache key
+
+    seed_sequence: np.random.SeedSequence
+        Seed of the network random stream, derived from seed
+        
+    Return
+    ------
+    G: ig.Graph()
+        The contact network
+
+    """
+
+    path = network_cache_dir() / "network_v{}_{}_{}.pickle".format(_NETWORK_CACHE_VERSION, n_of_families, seed)
+    if path.exists():
+        with open(path, "rb") as f:
+            G = unpack_network(load_record(f))
+    else:
+        # the cached network does not depend on use_probabilities, prob_inf is added below
+        G = generate_network(n_of_families, False, *create_generators(seed_sequence))
+        path.parent.mkdir(parents = True, exist_ok = True)
+        # concurrent runs may write the same network, the rename makes the file appear complete
+        tmp_path = path.with_name(path.name + "." + str(os.getpid()) + ".tmp")
+        with open(tmp_path, "wb") as f:
+            dump_record(pack_network(G), f)
+        os.replace(tmp_path, path)
+    if use_probabilities:
+        G.vs["prob_inf"] = 0.0
+    return G
+
+def init_infection(G, n_initial_infected_nodes, pyrng):
     """
     Make random nodes infected in the network
     
@@ -213,23 +322,28 @@ def init_infection(G, n_initial_infected_nodes):
     n_initial_infected_nodes: int
         Number of infected nodes to put on the network
 
+    pyrng: random.Random
+        Python random number generator
+
     Return
     ------
     None
 
     """
     
-    for node in random.sample(list(G.vs), n_initial_infected_nodes):
-        node["agent_status"] = "E"
-        node["infected"] = True
-        node["days_from_infection"] = 1
+    infected_nodes = G.vs[pyrng.sample(range(G.vcount()), n_initial_infected_nodes)]
+    infected_nodes["agent_status"] = "E"
+    infected_nodes["infected"] = True
+    infected_nodes["days_from_infection"] = 1
 
     if "prob_inf" in G.vs.attributes():
-        number_of_nodes = len(list(G.vs))
-        for node in G.vs:
-            node["prob_inf"] = n_initial_infected_nodes / number_of_nodes
+        G.vs["prob_inf"] = n_initial_infected_nodes / G.vcount()
+
+# average weighted degree of already seen networks, used by compute_TR
+_average_degree_cache = dict()
+_AVERAGE_DEGREE_CACHE_SIZE = 64
 
-def compute_TR(G, R_0, infection_duration, incubation_days):
+def compute_TR(G, R_0, infection_duration, incubation_days, rng, cache_key = None):
     """
     Compute the transmission rate of the disease in the network.
     The factor is computed as R_0 / (average_weighted_degree * (infection_duration - incubation_days))
@@ -248,6 +362,14 @@ def compute_TR(G, R_0, infection_duration, incubation_days):
     incubation_days: int
         Average number of days where the patient is not infective
 
+    rng: np.random.Generator
+        Random number generator
+
+    cache_key: hashable
+        Key identifying the network, e.g. (n_of_families, seed) for seeded runs.
+        If given, the average weighted degree is computed only the first time the key is seen.
+        rng must not be shared with the simulation, otherwise a cache hit changes its random stream
+
     Return
     ------
     transmission_rate: float
@@ -255,13 +377,22 @@ def compute_TR(G, R_0, infection_duration, incubation_days):
 
     """
 
-    avr_deg = list()
-    # compute average weighted degree on 20 steps
-    for i in range (20):
-        step(G, i, 0, 0, 0, 0, 0, 0, False, list(), 0, "Random", 0, 0, False, 0, 0, 0)
-
-        degrees = G.strength(list(range(len(G.vs))), weights = "weight")
-        avr_deg.append(sum(degrees) / len(degrees))
-    #reset network status
-    reset_network(G)
-    return R_0 /((infection_duration - incubation_days) * (sum(avr_deg) / len(avr_deg)))
\ No newline at end of file
+    if cache_key is not None and cache_key in _average_degree_cache:
+        avr_deg = _average_degree_cache[cache_key]
+    else:
+        degrees_sum = 0
+        # compute average weighted degree on 20 steps
+        for i in range (20):
+            step(G, i, 0, 0, 0, 0, 0, 0, False, list(), 0, "Random", 0, 0, False, 0, 0, 0, rng)
+
+            degrees = G.strength(weights = "weight")
+            degrees_sum += sum(degrees) / len(degrees)
+        avr_deg = degrees_sum / 20
+        #reset network status
+        reset_network(G)
+        if cache_key is not None:
+            if len(_average_degree_cache) >= _AVERAGE_DEGREE_CACHE_SIZE:
+                # drop the oldest entry
+                del _average_degree_cache[next(iter(_average_degree_cache))]
+            _average_degree_cache[cache_key] = avr_deg
+    return R_0 /((infection_duration - incubation_days) * avr_deg)
\ No newline at end of file
@@ -1,11 +1,81 @@
-import random
 import numpy as np
 try:
-    from ctns.utility import retrive_to_test_quarantine, perform_test, compute_sd_reduction
+    from ctns.utility import retrive_to_test_quarantine, perform_test, compute_sd_reduction, snapshot_contacts, compute_adjacency, compute_strength, \
+        read_node_state, write_node_state, SUSCEPTIBLE, EXPOSED, INFECTIVE, RECOVERED, DEAD, WEIGHT_DTYPE
 except ImportError as e:
-    from utility import retrive_to_test_quarantine, perform_test, compute_sd_reduction
+    from utility import retrive_to_test_quarantine, perform_test, compute_sd_reduction, snapshot_contacts, compute_adjacency, compute_strength, \
+        read_node_state, write_node_state, SUSCEPTIBLE, EXPOSED, INFECTIVE, RECOVERED, DEAD, WEIGHT_DTYPE
 
-def generate_family_edges(G):
+# symptoms of the nodes that become infective. A case value below 0.8 is a mild case, otherwise it is severe;
+# each symptom of the table is shown if the case value is below its threshold
+MILD_CASE_THRESHOLD = 0.8
+MILD_SYMPTOMS = (("Loss of taste or smell", 0.05), ("Fever", 0.2), ("Cough", 0.2), ("Tiredness", 0.2))
+SEVERE_SYMPTOMS = (("Fever", 0.99), ("Tiredness", 0.7), ("Cough", 0.6), ("Dyspnea", 0.3))
+
+def add_contact_edges(G, toAdd, weights, category):
+    """
+    Add edges to the contact network, setting their attributes in bulk.
+    The edges must not be already in the network, nor repeated in toAdd
+    
+    Parameters
+    ----------
+    G: ig.Graph()
+        The contact network
+
+    toAdd: list of pairs of int
+        The edges to add
+
+    weights: list of int or int
+        The weight of each edge, or a single weight for all of them
+
+    category: string
+        Category of the edges
+
+    Return
+    ------
+    None
+
+    """
+
+    # new edges are appended, their ids follow the ones already in the network
+    first = G.ecount()
+    G.add_edges(toAdd)
+    G.es[first:]["weight"] = weights
+    G.es[first:]["category"] = category
+
+def new_contact_edges(G, sources, targets):
+    """
+    Select the candidate edges that are not already in the contact network.
+    Self loops and candidates repeated in any direction are dropped
+    
+    Parameters
+    ----------
+    G: ig.Graph()
+        The contact network
+
+    sources: np.array of int
+        First endpoint of each candidate edge
+
+    targets: np.array of int
+        Second endpoint of each candidate edge
+
+    Return
+    ------
+    toAdd: list of pairs of int
+        The new edges, as (lower endpoint, higher endpoint)
+
+    """
+
+    n_nodes = G.vcount()
+    keep = sources != targets
+    # an edge is identified by lower endpoint * n_nodes + higher endpoint
+    keys = np.unique(np.minimum(sources, targets)[keep] * n_nodes + np.maximum(sources, targets)[keep])
+    edges = np.array(G.get_edgelist(), dtype = np.int64).reshape(-1, 2)
+    keys = keys[~np.isin(keys, edges.min(axis = 1) * n_nodes + edges.max(axis = 1))]
+
+    return list(zip((keys // n_nodes).tolist(), (keys % n_nodes).tolist()))
+
+def generate_family_edges(G, available, rng):
     """
     Generate family edges. All edges between nodes of the same family are created
     
@@ -13,6 +83,12 @@ def generate_family_edges(G):
     ----------
     G: ig.Graph()
         The contact network
+
+    available: np.array of bool
+        If each node can have contacts (not dead and not in quarantine)
+
+    rng: np.random.Generator
+        Random number generator
         
     Return
     ------
@@ -20,23 +96,18 @@ def generate_family_edges(G):
 
     """
 
-    toAdd = []
+    # families never change, so their edges are collected in a single (n, 2) array
+    # the first time and kept as a private graph attribute, that pack_network does not dump
+    if "_family_edges" not in G.attributes():
+        edges = np.array([edge for contacts in G.vs["family_contacts"] for edge in contacts], dtype = np.int64).reshape(-1, 2)
+        # each contact is listed by both its members, only the one from the lower endpoint is kept
+        G["_family_edges"] = edges[edges[:, 0] < edges[:, 1]]
+    edges = G["_family_edges"]
+    toAdd = edges[available[edges[:, 0]] & available[edges[:, 1]]].tolist()
 
-    for node in G.vs:
-        for edge in node["family_contacts"]:
-            if G.vs[edge[0]]["agent_status"] != "D" \
-            and G.vs[edge[1]]["agent_status"] != "D" \
-            and not G.vs[edge[0]]["quarantine"] \
-            and not G.vs[edge[1]]["quarantine"]:
-                toAdd.append(edge)
+    add_contact_edges(G, toAdd, rng.integers(3, 8, len(toAdd)).tolist(), "family_contacts")
 
-    weights = np.random.randint(3, 8, len(toAdd))
-    G.add_edges(toAdd)
-    for (edge_index, i) in zip(G.get_eids(toAdd, directed = False), range(len(weights))):
-      G.es[edge_index]["weight"] = weights[i]
-      G.es[edge_index]["category"] = "family_contacts"  
-
-def generate_occfreq_edges(G, edge_category, restriction_value):
+def generate_occfreq_edges(G, available, edge_category, restriction_value, rng):
     """
     Create edges from the node of type edge_category
     The number of edges is chosen according to the sociability of the node
@@ -46,11 +117,17 @@ def generate_occfreq_edges(G, edge_category, restriction_value):
     G: ig.Graph()
         The contact network
 
+    available: np.array of bool
+        If each node can have contacts (not dead and not in quarantine)
+
     edge_category: string
         Category of the edge attribute
     
     restriction_value: float
         How many edges are dropped in proportion to normal condition?
+
+    rng: np.random.Generator
+        Random number generator
         
     Return
     ------
@@ -58,37 +135,35 @@ def generate_occfreq_edges(G, edge_category, restriction_value):
 
     """
 
-    toAdd = []
-
-    for node in G.vs:
-        possible_edges = node[edge_category].copy()
-        random.shuffle(possible_edges)
-        tmp = int(len(possible_edges) / 3)
-        tmp2 = int(2 * len(possible_edges) / 3)
-        if node["sociability"] == "low":
-            n_edges = int(random.random() * tmp)
-        if node["sociability"] == "medium":
-            n_edges = tmp + int(random.random() * (tmp2 - tmp))
-        if node["sociability"] == "high":
-            n_edges = tmp2 + int(random.random() * (len(possible_edges) + 1 - tmp2))
-        n_edges = int(n_edges * restriction_value)
-
-        for i in range (0, n_edges):
-            edge = possible_edges[i]
-            if G.vs[edge[0]]["agent_status"] != "D" \
-            and G.vs[edge[1]]["agent_status"] != "D" \
-            and not G.vs[edge[0]]["quarantine"] \
-            and not G.vs[edge[1]]["quarantine"] \
-            and not G[edge[0], edge[1]]:
-                toAdd.append(edge)
-
-    weights = np.random.randint(1, 6, len(toAdd))
-    G.add_edges(toAdd)
-    for (edge_index, i) in zip(G.get_eids(toAdd, directed = False), range(len(weights))):
-      G.es[edge_index]["weight"] = weights[i]
-      G.es[edge_index]["category"]= edge_category  
-
-def generate_random_edges(G, number_of_random_edges, restriction_value):
+    n_nodes = G.vcount()
+    # the contact lists never change, so they are collected in a single (n, 2) array, grouped by node,
+    # the first time and kept as a private graph attribute, that pack_network does not dump
+    edges_name = "_" + edge_category.split("_")[0] + "_edges"
+    if edges_name not in G.attributes():
+        G[edges_name] = np.array([edge for contacts in G.vs[edge_category] for edge in contacts], dtype = np.int64).reshape(-1, 2)
+    edges = G[edges_name]
+    n_contacts = np.bincount(edges[:, 0], minlength = n_nodes)
+
+    # the number of edges of a node is drawn in the third of its contacts given by its sociability
+    sociability = np.array(G.vs["sociability"])
+    low, medium = sociability == "low", sociability == "medium"
+    one_third, two_thirds = n_contacts // 3, 2 * n_contacts // 3
+    lower = np.select([low, medium], [0, one_third], two_thirds)
+    upper = np.select([low, medium], [one_third, two_thirds], n_contacts + 1)
+    n_edges = lower + (rng.random(n_nodes) * (upper - lower)).astype(np.int64)
+    n_edges = (n_edges * restriction_value).astype(np.int64)
+
+    # a random key per contact shuffles the contacts of each node, the first n_edges of each node are drawn
+    order = np.lexsort((rng.random(len(edges)), edges[:, 0]))
+    owners = edges[order, 0]
+    rank = np.arange(len(edges)) - (np.cumsum(n_contacts) - n_contacts)[owners]
+    drawn = edges[order[rank < n_edges[owners]]]
+    drawn = drawn[available[drawn[:, 0]] & available[drawn[:, 1]]]
+
+    toAdd = new_contact_edges(G, drawn[:, 0], drawn[:, 1])
+    add_contact_edges(G, toAdd, rng.integers(1, 6, len(toAdd)).tolist(), edge_category)
+
+def generate_random_edges(G, available, number_of_random_edges, restriction_value, rng):
     """
     Create number_of_random_edges random edges in the contact network
     
@@ -96,12 +171,18 @@ def generate_random_edges(G, number_of_random_edges, restriction_value):
     ----------
     G: ig.Graph()
         The contact network
+
+    available: np.array of bool
+        If each node can have contacts (not dead and not in quarantine)
         
     number_of_random_edges : int
         Number of edges to create
     
     restriction_value: float
         How many edges are dropped in proportion to normal condition?
+
+    rng: np.random.Generator
+        Random number generator
         
     Return
     ------
@@ -109,27 +190,14 @@ def generate_random_edges(G, number_of_random_edges, restriction_value):
 
     """
 
-    toAdd = []
     number_of_random_edges = int(number_of_random_edges * restriction_value)
-    edge_list = np.random.randint(0, len(list(G.vs)) - 1, 2 * number_of_random_edges)
-    for i in range (0, 2 * number_of_random_edges, 2):
-        source = edge_list[i]
-        target = edge_list[i + 1]
-        if not G[source, target] \
-        and source != target \
-        and G.vs[source]["agent_status"] != "D" \
-        and G.vs[target]["agent_status"] != "D" \
-        and not G.vs[source]["quarantine"] \
-        and not G.vs[target]["quarantine"] \
-        and not G[source, target]:
-            toAdd.append((source, target))
+    source, target = rng.integers(0, G.vcount(), (2, number_of_random_edges))
+    keep = available[source] & available[target]
 
-    G.add_edges(toAdd)
-    for edge_index in G.get_eids(toAdd, directed = False):
-      G.es[edge_index]["weight"] = 1
-      G.es[edge_index]["category"]= "random_contacts"  
+    toAdd = new_contact_edges(G, source[keep], target[keep])
+    add_contact_edges(G, toAdd, 1, "random_contacts")
 
-def step_edges(G, restriction_value):
+def step_edges(G, state, restriction_value, rng):
     """
     Removes old edges and creates new edges
     
@@ -138,8 +206,14 @@ def step_edges(G, restriction_value):
     G: ig.Graph()
         The contact network
 
+    state: dict
+        The node state, see read_node_state
+
     restriction_value: float
         How many edges are dropped in proportion to normal condition?
+
+    rng: np.random.Generator
+        Random number generator
         
     Return
     ------
@@ -147,27 +221,22 @@ def step_edges(G, restriction_value):
 
     """
     
-    G.delete_edges(list(G.es))
+    # delete_edges(None) does not delete all the edges in every igraph version, a range is always accepted
+    G.delete_edges(range(G.ecount()))
 
-    generate_family_edges(G)
+    # dead and quarantined nodes have no contacts
+    available = (state["agent_status"] != DEAD) & (state["quarantine"] == 0)
 
-    generate_occfreq_edges(G, "frequent_contacts", restriction_value)
-    generate_occfreq_edges(G, "occasional_contacts", restriction_value)
+    generate_family_edges(G, available, rng)
 
-    random_contact_total = len(list(G.vs)) + random.random() * (7 * len(list(G.vs)) - len(list(G.vs)))
-    generate_random_edges(G, random_contact_total, restriction_value)
+    generate_occfreq_edges(G, available, "frequent_contacts", restriction_value, rng)
+    generate_occfreq_edges(G, available, "occasional_contacts", restriction_value, rng)
 
-    # since edge generation produce a multigraph but a single edge has attributes as wanted,
-    # all other edges are removed. This produce a simple graph
-    # this operation is way much faster than checking befor adding new edge
-    
-    toRemove = list()
-    for edge in G.es:
-        if edge["weight"] == None:
-            toRemove.append(edge)
-    G.delete_edges(toRemove)  
+    n_nodes = G.vcount()
+    random_contact_total = n_nodes + rng.random() * (7 * n_nodes - n_nodes)
+    generate_random_edges(G, available, random_contact_total, restriction_value, rng)
 
-def step_spread(G, incubation_days, infection_duration, transmission_rate, use_probabilities, alpha, gamma):
+def step_spread(G, state, adjacency, incubation_days, infection_duration, transmission_rate, use_probabilities, alpha, gamma, rng):
     """
     Make the infection spread across the network
     
@@ -176,6 +245,12 @@ def step_spread(G, incubation_days, infection_duration, transmission_rate, use_p
     G: ig.Graph()
         The contact network
 
+    state: dict
+        The node state, see read_node_state. It is updated in place
+
+    adjacency: tuple of np.array
+        Adjacency of the network in CSR form, see compute_adjacency
+
     incubation_days: int
         Average number of days where the patient is not infective
 
@@ -194,6 +269,9 @@ def step_spread(G, incubation_days, infection_duration, transmission_rate, use_p
     gamma: float
         Parameter to regulate probability of being infected contact diffusion. Domain = (0, +inf). Higher values corresponds to stronger probability diffusion
 
+    rng: np.random.Generator
+        Random number generator
+
     Return
     ------
     None
@@ -201,81 +279,80 @@ def step_spread(G, incubation_days, infection_duration, transmission_rate, use_p
     """
 
     if use_probabilities:
-        old_prob =  G.vs["prob_inf"]
-
-    for node in G.vs:
-        # update parameters if node is infected
-        if node["infected"] == True:
-            node["days_from_infection"] += 1
-            if node["days_from_infection"] == infection_duration:
-                # if infection is over, it will be dead of recovered
-                node["agent_status"] = np.random.choice(["R", "D"], p = (1 - node["death_rate"], node["death_rate"]))
-                node["infected"] = False
-                node["symptoms"] = list()
-                node["days_from_infection"] = 0
-                node["needs_IC"] = False
-                if node["agent_status"] == "D":
-                    node["quarantine"] = 0
-                    node["test_result"] = - 1
-                    if use_probabilities:
-                        node["prob_inf"] = 0
-                
-            # if it is still infective, spread the infection with his contacts
-            if node["agent_status"] == "I":
-                for contact in G.neighborhood(node)[1:]:
-                    if G.vs[contact]["agent_status"] == "S":
-                        prob = transmission_rate * G[node, contact] # access to the weight of the edge
-                        # has the new node been infected?
-                        G.vs[contact]["agent_status"] = np.random.choice(["S", "E"], p = (1 - prob, prob))
-                        if G.vs[contact]["agent_status"] == "E":
-                            G.vs[contact]["infected"] = True
-                            G.vs[contact]["days_from_infection"] = 1
-
-            # if the node become I, pick some symptoms
-            if node["agent_status"] == "E" and node["days_from_infection"] == incubation_days:
-                node["agent_status"] = "I"
-                #if mild case
-                case = random.uniform(0, 1)
-                if case < 0.8:
-                    if case < 0.05:
-                        node["symptoms"].append("Loss of taste or smell")
-                    if case < 0.2:
-                        node["symptoms"].append("Fever")
-                    if case < 0.2:
-                        node["symptoms"].append("Cough")
-                    if case < 0.2:
-                        node["symptoms"].append("Tiredness")
-                # if severe
-                else:
-                    if case < 0.99:
-                        node["symptoms"].append("Fever")
-                    if case < 0.7:
-                        node["symptoms"].append("Tiredness")
-                    if case < 0.6:
-                        node["symptoms"].append("Cough")
-                    if case < 0.3:
-                        node["symptoms"].append("Dyspnea")
-                
-                if random.uniform(0, 1) < 0.02:
-                    node["needs_IC"] = True
+        prob_inf = state["prob_inf"]
+        old_prob = prob_inf.copy()
+
+    # the transitions below work on whole arrays
+    agent_status = state["agent_status"]
+    infected = state["infected"]
+    days_from_infection = state["days_from_infection"]
+    quarantine = state["quarantine"]
+    test_result = state["test_result"]
+    needs_IC = state["needs_IC"]
+    symptoms = G.vs["symptoms"]
+
+    # update parameters if node is infected
+    days_from_infection[infected] += 1
+    # exposed nodes that end incubation today, they become infective after spreading
+    end_incubation = np.flatnonzero((agent_status == EXPOSED) & (days_from_infection == incubation_days))
+
+    # if infection is over, it will be dead of recovered
+    over = np.flatnonzero(infected & (days_from_infection == infection_duration))
+    dead = rng.random(len(over)) < np.array(G.vs["death_rate"])[over]
+    agent_status[over] = np.where(dead, DEAD, RECOVERED)
+    infected[over] = False
+    days_from_infection[over] = 0
+    needs_IC[over] = False
+    for node in over.tolist():
+        symptoms[node] = list()
+    over = over[dead]
+    quarantine[over] = 0
+    test_result[over] = -1
+    if use_probabilities:
+        prob_inf[over] = 0
+
+    # if it is still infective, spread the infection with his contacts
+    # each contact between an infective and a susceptible node is an independent Bernoulli trial,
+    # a susceptible node is exposed if at least one trial succeeds
+    indptr, indices, weights = adjacency
+    sources = np.repeat(np.arange(len(agent_status)), np.diff(indptr))
+    trials = np.flatnonzero((agent_status[sources] == INFECTIVE) & (agent_status[indices] == SUSCEPTIBLE))
+    # has the new node been infected?
+    hits = rng.random(len(trials)) < transmission_rate * weights[trials]
+    exposed = np.unique(indices[trials[hits]])
+    agent_status[exposed] = EXPOSED
+    infected[exposed] = True
+    days_from_infection[exposed] = 1
+
+    # if the node become I, pick some symptoms
+    agent_status[end_incubation] = INFECTIVE
+    # the case values and the intensive care draws of all the nodes are drawn in a single block
+    cases, intensive_care = rng.random((2, len(end_incubation)))
+    needs_IC[end_incubation[intensive_care < 0.02]] = True
+    for node, case in zip(end_incubation.tolist(), cases.tolist()):
+        table = MILD_SYMPTOMS if case < MILD_CASE_THRESHOLD else SEVERE_SYMPTOMS
+        symptoms[node].extend([symptom for symptom, threshold in table if case < threshold])
+
+    G.vs["symptoms"] = symptoms
 
     # update prob of being infected
     if use_probabilities:
-        nodes_contact_probs = [1] * len(list(G.vs))   
-        
-        for edge in G.es:
-            weight = edge["weight"]
-            source = edge.source
-            target = edge.target
-            nodes_contact_probs[source] *= 1 - (1 - 1 / (1 + alpha * 21)) * old_prob[target] * (1 - np.e**(- gamma * weight))
-            nodes_contact_probs[target] *= 1 - (1 - 1 / (1 + alpha * 21)) * old_prob[source] * (1 - np.e**(- gamma * weight))
-
-        for node in G.vs:
-            if node["agent_status"] != "D" and not (node["test_result"] == 0 and node["agent_status"] == "R"):
-                index = node.index
-                node["prob_inf"] = 1 - (1 / (1 + alpha * 21)) * old_prob[index] - (1 - old_prob[index]) * nodes_contact_probs[index]
+        # each contact of a node multiplies its contact probability by a factor.
+        # This is a matrix-vector product on the adjacency, with product instead of sum:
+        # the factors of a node are contiguous in CSR form and are reduced in a single pass
+        # contact weights are small integers, the exponential is computed once per possible weight
+        weight_factor = 1 - np.exp(- gamma * np.arange(np.iinfo(WEIGHT_DTYPE).max + 1))
+        factors = 1 - (1 - 1 / (1 + alpha * 21)) * old_prob[indices] * weight_factor[weights]
+        nodes_contact_probs = np.ones(G.vcount())
+        # reduceat does not handle empty rows, nodes without contacts keep 1
+        with_contacts = np.flatnonzero(np.diff(indptr))
+        if len(with_contacts):
+            nodes_contact_probs[with_contacts] = np.multiply.reduceat(factors, indptr[with_contacts])
+
+        alive = (agent_status != DEAD) & ~((test_result == 0) & (agent_status == RECOVERED))
+        prob_inf[alive] = (1 - (1 / (1 + alpha * 21)) * old_prob - (1 - old_prob) * nodes_contact_probs)[alive]
    
-def step_test(G, nets, incubation_days, n_new_test, policy_test, contact_tracing_efficiency, quarantine_efficiency, use_probabilities, lambdaa):
+def step_test(G, state, adjacency, nets, incubation_days, n_new_test, policy_test, contact_tracing_efficiency, quarantine_efficiency, use_probabilities, lambdaa, rng, betweenness_cutoff = None):
     """
     Test some nodes of the network and put the in quarantine if needed
     
@@ -284,8 +361,14 @@ def step_test(G, nets, incubation_days, n_new_test, policy_test, contact_tracing
     G: ig.Graph()
         The contact network
 
-    nets: list of ig.Graph()
-        History of the network
+    state: dict
+        The node state, see read_node_state. It is updated in place
+
+    adjacency: tuple of np.array
+        Adjacency of the network in CSR form, see compute_adjacency
+
+    nets: list of dict
+        History of the contacts, see snapshot_contacts
     
     incubation_days: int
         Average number of days where the patient is not infective
@@ -309,6 +392,12 @@ def step_test(G, nets, incubation_days, n_new_test, policy_test, contact_tracing
     lambdaa: float
         Parameter to regulate influence of contacts with a positive. Domain = (0, 1). Higher values corresponds to stronger probability diffusion
 
+    rng: np.random.Generator
+        Random number generator
+
+    betweenness_cutoff: float
+        Maximum length of the paths counted by the Betweenness Centrality policy, None to count all the paths
+
     Return
     ------
     new_positive_counter: int
@@ -316,34 +405,35 @@ def step_test(G, nets, incubation_days, n_new_test, policy_test, contact_tracing
 
     """
 
+    # weighted degrees are read from the adjacency of the step, once for tests and quarantine
+    if policy_test == "Degree Centrality":
+        strength = compute_strength(adjacency)
+    # the topology does not change inside step_test, betweenness of all nodes is computed at most once
+    betweenness = None
+
+    agent_status = state["agent_status"]
+    quarantine = state["quarantine"]
+    test_validity = state["test_validity"]
+    test_result = state["test_result"]
+    if use_probabilities:
+        prob_inf = state["prob_inf"]
+
     # create pool of nodes to test
-    high_priority_test_pool = set()
-    low_priority_test_pool = set()
-    for node in G.vs:
-        # update quarantine
-        if node["quarantine"] > 0:
-            node["quarantine"] -= 1
-            # if node has been found positive and quarantine is over, re-test the node
-            if node["quarantine"] == 0 and node["test_result"] == 1:
-                high_priority_test_pool.add(node.index)
-        # update test validity
-        if node["test_validity"] > 0:
-            node["test_validity"] -= 1
-        # test also detect if the node is recovered (sierological test)
-        # if node is not dead, if test validity is expired, if node is not a known recovered, add to low priority test pool
-        if node["agent_status"] != "D" and node["test_validity"] <= 0 \
-         and not (node["test_result"] == 0 and node["agent_status"] == "R"):
-            low_priority_test_pool.add(node.index)
-
-    low_priority_test_pool -= high_priority_test_pool
-    found_positive = set()
-    #cannot directly put nodes in a set cause node object are not supported
-    high_priority_test_pool = [G.vs[i] for i in high_priority_test_pool]
-    low_priority_test_pool = [G.vs[i] for i in low_priority_test_pool]
-    for node in high_priority_test_pool:
-        result = perform_test(node, incubation_days, use_probabilities)
-        if result:
-            found_positive.add(node.index)
+    # update quarantine
+    in_quarantine = quarantine > 0
+    quarantine[in_quarantine] -= 1
+    # if node has been found positive and quarantine is over, re-test the node
+    high_priority = in_quarantine & (quarantine == 0) & (test_result == 1)
+    # update test validity
+    test_validity[test_validity > 0] -= 1
+    # test also detect if the node is recovered (sierological test)
+    # if node is not dead, if test validity is expired, if node is not a known recovered, add to low priority test pool
+    low_priority = (agent_status != DEAD) & (test_validity <= 0) \
+        & ~((test_result == 0) & (agent_status == RECOVERED)) & ~high_priority
+
+    high_priority_test_pool = np.flatnonzero(high_priority).tolist()
+    low_priority_test_pool = np.flatnonzero(low_priority).tolist()
+    found_positive = set(perform_test(state, high_priority_test_pool, incubation_days, use_probabilities))
 
     to_test = list()
 
@@ -351,81 +441,90 @@ def step_test(G, nets, incubation_days, n_new_test, policy_test, contact_tracing
 
     if n_new_test:
         if policy_test == "Random":
-            to_test = random.sample(low_priority_test_pool, min(len(low_priority_test_pool), n_new_test))
+            to_test = rng.choice(low_priority_test_pool, min(len(low_priority_test_pool), n_new_test), replace = False).tolist()
 
         if policy_test == "Degree Centrality":
-            low_priority_test_pool_index = [x.index for x in low_priority_test_pool]
-            degree_results = G.strength(low_priority_test_pool_index, weights = "weight")
+            degree_results = strength[low_priority_test_pool].tolist()
             to_test = retrive_to_test_quarantine(low_priority_test_pool, degree_results, n_new_test)
 
         if policy_test == "Betweenness Centrality":
-            low_priority_test_pool_index = [x.index for x in low_priority_test_pool]
-            betweenness_results = G.betweenness(low_priority_test_pool_index, 
-                                                directed = False, weights = "weight",
-                                                cutoff = None)
+            betweenness = np.array(G.betweenness(directed = False, weights = "weight", cutoff = betweenness_cutoff))
+            betweenness_results = betweenness[low_priority_test_pool].tolist()
             to_test = retrive_to_test_quarantine(low_priority_test_pool, betweenness_results, n_new_test)
 
         if policy_test == "PBI":
-            probs_infected = [i["prob_inf"] for i in low_priority_test_pool]
+            probs_infected = prob_inf[low_priority_test_pool].tolist()
             to_test = retrive_to_test_quarantine(low_priority_test_pool, probs_infected, n_new_test)
 
-    for node in to_test:
-        result = perform_test(node, incubation_days, use_probabilities)
-        if result:
-            found_positive.add(node.index)
-            new_positive_counter += 1
+    positive = perform_test(state, to_test, incubation_days, use_probabilities)
+    found_positive.update(positive)
+    new_positive_counter += len(positive)
             
-    # tracked will contain family contacts (quarantine 100%), 
-    # possibly_tracked will contain other contacts, quarantine influenced by contact tracing efficiency
-    ct_nets = list(nets) + [G.copy()]
-
     if len(found_positive) > 0:
-        tracked = set()
-        possibly_tracked = set()
-        # trace contacts
-        for net in ct_nets:
-            for edge in net.es:
-                if edge["category"] == "family_contacts" \
-                and (edge.source in found_positive or edge.target in found_positive):
-                    if edge.source in found_positive:
-                        tracked.add(G.vs[edge.target].index)
-                    else:
-                        tracked.add(G.vs[edge.source].index)
-                else:
-                    if edge.source in found_positive:
-                        possibly_tracked.add(G.vs[edge.target].index)
-                    if edge.target in found_positive:
-                        possibly_tracked.add(G.vs[edge.source].index)
+        # tracked will contain family contacts (quarantine 100%), 
+        # possibly_tracked will contain other contacts, quarantine influenced by contact tracing efficiency
+        ct_nets = list(nets) + [snapshot_contacts(G)]
+        # both are kept as boolean masks over the nodes while tracing
+        tracked = np.zeros(G.vcount(), dtype = bool)
+        possibly_tracked = np.zeros(G.vcount(), dtype = bool)
+        is_positive = np.zeros(G.vcount(), dtype = bool)
+        is_positive[list(found_positive)] = True
+        # trace contacts, filtering the edges of each day with masks
+        for contacts in ct_nets:
+            # family contacts of a positive are always tracked
+            family_edges = contacts["edges"][:contacts["n_family"]]
+            sources, targets = family_edges[:, 0], family_edges[:, 1]
+            source_positive = is_positive[sources]
+            family = source_positive | is_positive[targets]
+            tracked[np.where(source_positive, targets, sources)[family]] = True
+            # the other contacts are tracked according to contact_tracing_efficiency
+            other_edges = contacts["edges"][contacts["n_family"]:]
+            sources, targets = other_edges[:, 0], other_edges[:, 1]
+            possibly_tracked[targets[is_positive[sources]]] = True
+            possibly_tracked[sources[is_positive[targets]]] = True
         
-        # set diff to remove double contacts
-        possibly_tracked -= tracked
+        # remove double contacts
+        possibly_tracked &= ~tracked
+        possibly_tracked = np.flatnonzero(possibly_tracked)
         if int(len(possibly_tracked) * contact_tracing_efficiency) > 0:
-            possibly_tracked = random.sample(possibly_tracked, int(len(possibly_tracked) * contact_tracing_efficiency))
-        else:
-            possibly_tracked = list(possibly_tracked)
-        tracked = list(tracked)
+            possibly_tracked = rng.choice(possibly_tracked, int(len(possibly_tracked) * contact_tracing_efficiency), replace = False)
+        possibly_tracked = possibly_tracked.tolist()
+        tracked = np.flatnonzero(tracked).tolist()
         if use_probabilities:
+            # nodes whose probability can change, lists are faster than arrays for single items
+            updatable = (agent_status != DEAD) & ~((test_result == 0) & (agent_status == RECOVERED))
+            # contact weights are small integers, so the decays lambdaa * e^(-days / weight)
+            # are tabulated by days (row) and weight (column)
+            inverse_weight = np.zeros(np.iinfo(WEIGHT_DTYPE).max + 1)
+            inverse_weight[1:] = 1 / np.arange(1, len(inverse_weight))
+            # current contacts use the row 1 as the ones of the last day, even without history
+            decay = lambdaa * np.exp(- np.outer(np.arange(max(len(nets), 1) + 1), inverse_weight))
             # update prob of being infected of current contact 
-            for node in tracked + possibly_tracked:
-                for contact in G.neighborhood(node)[1:]:
-                    contact_node = G.vs[contact]
-                    if contact_node["agent_status"] != "D" and not (contact_node["test_result"] == 0 and contact_node["agent_status"] == "R"):
-                        current_contact_weight = G[node, contact]
-                        contact_node["prob_inf"] = contact_node["prob_inf"] \
-                                                    + lambdaa * np.e**(-(1 / current_contact_weight)) * (1 - contact_node["prob_inf"])
+            # each update p = p + d * (1 - p) multiplies 1 - p by 1 - d, so all the updates
+            # of a contact can be applied at once, whatever their order
+            indptr, indices, weights = adjacency
+            traced = np.array(tracked + possibly_tracked, dtype = np.int64)
+            starts = indptr[traced]
+            counts = indptr[traced + 1] - starts
+            # adjacency entries of the traced nodes
+            entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            contacts = indices[entries]
+            keep = updatable[contacts]
+            not_infected = np.ones(len(prob_inf))
+            np.multiply.at(not_infected, contacts[keep], 1 - decay[1][weights[entries[keep]]])
 
-            
             # update prob of being infected of past tracked contact 
-                for net_index in range(1, len(nets) + 1):
-                    net = nets[- net_index]
-                    for contact in net.neighborhood(node)[1:]:
-                        contact_node = G.vs[contact]
-                        if contact_node["agent_status"] != "D" and not (contact_node["test_result"] == 0 and contact_node["agent_status"] == "R"):
-                            if contact in tracked + possibly_tracked:
-                                current_contact_weight = net[node, contact]
-                                # use net_index instead of net_index + 1 since net index is already +1 from line above 
-                                contact_node["prob_inf"] = contact_node["prob_inf"] \
-                                                            + lambdaa * np.e**(- (net_index) * (1 / current_contact_weight)) * (1 - contact_node["prob_inf"])
+            # only contacts between two traced nodes count, and they update both nodes
+            is_traced = np.zeros(len(prob_inf), dtype = bool)
+            is_traced[traced] = True
+            for net_index, contacts in enumerate(reversed(nets), start = 1):
+                both_traced = is_traced[contacts["edges"][:, 0]] & is_traced[contacts["edges"][:, 1]]
+                ends = contacts["edges"][both_traced].ravel()
+                ends_weights = np.repeat(contacts["weights"][both_traced], 2)
+                keep = updatable[ends]
+                np.multiply.at(not_infected, ends[keep], 1 - decay[net_index][ends_weights[keep]])
+
+            prob_inf[:] = 1 - (1 - prob_inf) * not_infected
         
         possibly_quarantine = list()
 
@@ -435,29 +534,28 @@ def step_test(G, nets, incubation_days, n_new_test, policy_test, contact_tracing
             possibly_quarantine = list()
         else:
             if policy_test == "Random":
-                possibly_quarantine = random.sample(possibly_tracked, int(len(possibly_tracked) * quarantine_efficiency))
+                possibly_quarantine = rng.choice(possibly_tracked, int(len(possibly_tracked) * quarantine_efficiency), replace = False).tolist()
             if policy_test == "Degree Centrality":
-                values = G.strength(possibly_tracked, weights = "weight")
+                values = strength[possibly_tracked].tolist()
                 possibly_quarantine = retrive_to_test_quarantine(possibly_tracked, values, int(len(possibly_tracked) * quarantine_efficiency))
             if policy_test == "Betweenness Centrality":
-                values = G.betweenness(possibly_tracked, directed = False, weights = "weight", cutoff = None)
+                if betweenness is None:
+                    betweenness = np.array(G.betweenness(directed = False, weights = "weight", cutoff = betweenness_cutoff))
+                values = betweenness[possibly_tracked].tolist()
                 possibly_quarantine = retrive_to_test_quarantine(possibly_tracked, values, int(len(possibly_tracked) * quarantine_efficiency))
             if policy_test == "PBI":
-                values = [G.vs[x]["prob_inf"] for x in possibly_tracked]
+                values = prob_inf[possibly_tracked].tolist()
                 possibly_quarantine = retrive_to_test_quarantine(possibly_tracked, values, int(len(possibly_tracked) * quarantine_efficiency))
 
-        to_quarantine = [G.vs[i] for i in tracked + possibly_quarantine]
-        
         # put them in quarantine
-        for node in to_quarantine:
-            node["quarantine"] = 14
+        quarantine[tracked + possibly_quarantine] = 14
 
     return new_positive_counter
 
 def step(G, step_index, incubation_days, infection_duration, transmission_rate,
          initial_day_restriction, restriction_duration, social_distance_strictness,
          restriction_decreasing, nets, n_test, policy_test, contact_tracing_efficiency,
-         quarantine_efficiency, use_probabilities, alpha, gamma, lambdaa):
+         quarantine_efficiency, use_probabilities, alpha, gamma, lambdaa, rng, betweenness_cutoff = None):
     """
     Advance the simulation of one step
     
@@ -492,8 +590,8 @@ def step(G, step_index, incubation_days, infection_duration, transmission_rate,
     restriction_decreasing: bool
         If the social distancing will decrease the strictness during the restriction_duration period
 
-    nets: list of ig.Graph()
-        History of the network
+    nets: list of dict
+        History of the contacts, see snapshot_contacts
 
     n_test: int
         Number of avaiable tests
@@ -519,6 +617,12 @@ def step(G, step_index, incubation_days, infection_duration, transmission_rate,
     lambdaa: float
         Parameter to regulate influence of contacts with a positive. Domain = (0, 1). Higher values corresponds to stronger probability diffusion
 
+    rng: np.random.Generator
+        Random number generator
+
+    betweenness_cutoff: float
+        Maximum length of the paths counted by the Betweenness Centrality policy, None to count all the paths
+
     Return
     ------
     G: ig.Graph()
@@ -530,26 +634,33 @@ def step(G, step_index, incubation_days, infection_duration, transmission_rate,
         
     """
 
+    # node attributes are read once in arrays shared by the step phases, and written back at the end
+    state = read_node_state(G)
+
     # generate new edges
     if not restriction_duration:
         if step_index >= initial_day_restriction:
-            step_edges(G, 1 - (25 * social_distance_strictness / 100))
+            step_edges(G, state, 1 - (25 * social_distance_strictness / 100), rng)
         else:
-            step_edges(G, 1)
+            step_edges(G, state, 1, rng)
     else:
         if step_index >= initial_day_restriction and step_index < initial_day_restriction + restriction_duration:
             if restriction_decreasing:
                 social_distance_strictness = compute_sd_reduction(step_index, initial_day_restriction, restriction_duration, social_distance_strictness)
-                step_edges(G, 1 - (25 * social_distance_strictness / 100))
+                step_edges(G, state, 1 - (25 * social_distance_strictness / 100), rng)
             else:
-                step_edges(G, 1 - (25 * social_distance_strictness / 100))
+                step_edges(G, state, 1 - (25 * social_distance_strictness / 100), rng)
         else:
-            step_edges(G, 1)
+            step_edges(G, state, 1, rng)
     
+    # neighbors and weights are looked up many times, build the adjacency once per step
+    adjacency = compute_adjacency(G)
+
     # spread infection
-    step_spread(G, incubation_days, infection_duration, transmission_rate, use_probabilities, alpha, gamma)
+    step_spread(G, state, adjacency, incubation_days, infection_duration, transmission_rate, use_probabilities, alpha, gamma, rng)
           
     # make some test on nodes
-    new_positive_counter = step_test(G, nets, incubation_days, n_test, policy_test, contact_tracing_efficiency, quarantine_efficiency, use_probabilities, lambdaa)
+    new_positive_counter = step_test(G, state, adjacency, nets, incubation_days, n_test, policy_test, contact_tracing_efficiency, quarantine_efficiency, use_probabilities, lambdaa, rng, betweenness_cutoff)
+    write_node_state(G, state)
 
     return G, new_positive_counter
\ No newline at end of file
@@ -1,5 +1,53 @@
+import igraph as ig
 import numpy as np
-from collections import Counter
+import pickle, io, random, os, uuid
+from pathlib import Path
+try:
+    import zstandard
+except ImportError as e:
+    zstandard = None
+
+# possible values of agent_status, the position is the code used in NumPy arrays
+STATUS_LABELS = ("S", "E", "I", "R", "D")
+_STATUS_LOOKUP = np.zeros(128, dtype = np.int8)
+for code, label in enumerate(STATUS_LABELS):
+    _STATUS_LOOKUP[ord(label)] = code
+
+SUSCEPTIBLE, EXPOSED, INFECTIVE, RECOVERED, DEAD = range(len(STATUS_LABELS))
+
+# contact weights are small integers (3 to 7 for family contacts, 1 to 5 for the others, 1 for random ones),
+# snapshots and adjacencies store them in a single byte
+WEIGHT_DTYPE = np.int8
+
+# node attributes changed by the simulation steps, see read_node_state
+NODE_STATE_ATTRIBUTES = ("agent_status", "infected", "days_from_infection", "quarantine", "test_validity", "test_result", "needs_IC")
+
+# daily series of the light dump, stored as int32 arrays indexed by step
+REPORT_SERIES = STATUS_LABELS + ("quarantined", "positive", "tested", "total", "new_positive_counter")
+
+def create_generators(seed_sequence):
+    """
+    Create the NumPy and the Python random number generators of a random stream
+
+    Parameters
+    ----------
+    seed_sequence: np.random.SeedSequence
+        Seed of the stream
+
+    Return
+    ------
+    rng: np.random.Generator
+        Random number generator, using the SFC64 bit generator
+
+    pyrng: random.Random
+        Python random number generator, seeded from the same stream
+
+    """
+
+    # SFC64 is the fastest NumPy bit generator, the simulation makes millions of small draws
+    rng = np.random.Generator(np.random.SFC64(seed_sequence))
+    pyrng = random.Random(int(seed_sequence.generate_state(1, np.uint64)[0]))
+    return rng, pyrng
 
 def fix_distribution_node_number(distribution, n_nodes):
     """
@@ -45,26 +93,149 @@ def reset_network(G):
 
     """
 
-    G.delete_edges(list(G.es))
-    for node in G.vs:
-        node["agent_status"] = 'S'
-        node["infected"] = False
-        node["days_from_infection"] = 0
-        node["quarantine"] = 0
-        node["test_validity"] = 0
-        node["test_result"] = -1
-        node["symptoms"] = list()
-        if "prob_inf" in G.vs.attributes():
-            node["prob_inf"] = 0.0
+    G.delete_edges(range(G.ecount()))
+    # a single value is assigned to all the nodes at once
+    G.vs["agent_status"] = 'S'
+    G.vs["infected"] = False
+    G.vs["days_from_infection"] = 0
+    G.vs["quarantine"] = 0
+    G.vs["test_validity"] = 0
+    G.vs["test_result"] = -1
+    # each node needs its own list
+    G.vs["symptoms"] = [list() for _ in range(G.vcount())]
+    if "prob_inf" in G.vs.attributes():
+        G.vs["prob_inf"] = 0.0
+
+def encode_status(agent_status):
+    """
+    Convert a list of agent_status values in an array of codes,
+    following the order of STATUS_LABELS
+    
+    Parameters
+    ----------
+
+    agent_status: list of string
+        Values of the agent_status attribute
+
+    Return
+    ------
+    codes: np.array of int8
+        The status codes
+
+    """
+
+    return _STATUS_LOOKUP[np.array(agent_status, dtype = "U1").view(np.int32)]
+
+def init_dump_report(n_steps, use_probabilities):
+    """
+    Create the simulation dump in case light dump is selected,
+    with room for n_steps days
+    
+    Parameters
+    ----------
+    n_steps: int
+        Number of days preallocated, the series are grown if more are needed
+
+    use_probabilities: bool
+        Enables probabilities of being infected estimation
+
+    Return
+    ------
+    to_dump: dict
+        Dump doctionary, with a zeroed array for each series
+
+    """
+
+    to_dump = dict()
+    for key in REPORT_SERIES:
+        to_dump[key] = np.zeros(n_steps, dtype = np.int32)
+    to_dump['avg_prob_inf'] = np.zeros(n_steps if use_probabilities else 0)
+    return to_dump
+
+def trim_dump_report(to_dump, n_steps):
+    """
+    Drop the preallocated days that were not simulated from the light dump
+    
+    Parameters
+    ----------
+    to_dump: dict
+        Dump doctionary
+
+    n_steps: int
+        Number of simulated days
+
+    Return
+    ------
+    to_dump: dict
+        Trimmed dump doctionary
+
+    """
+
+    for key in REPORT_SERIES + ('avg_prob_inf',):
+        to_dump[key] = to_dump[key][:n_steps]
+    return to_dump
+
+def read_node_state(G):
+    """
+    Read the node attributes changed by the simulation steps in NumPy arrays, one per attribute.
+    agent_status is stored as int8 codes, see STATUS_LABELS
+    
+    Parameters
+    ----------
+    G: ig.Graph()
+        The contact network
+
+    Return
+    ------
+    state: dict
+        Arrays indexed by node, keyed by attribute name (see NODE_STATE_ATTRIBUTES).
+        prob_inf is included if present in the network
+
+    """
+
+    state = dict()
+    state["agent_status"] = encode_status(G.vs["agent_status"])
+    for attribute in NODE_STATE_ATTRIBUTES[1:]:
+        state[attribute] = np.array(G.vs[attribute])
+    if "prob_inf" in G.vs.attributes():
+        state["prob_inf"] = np.array(G.vs["prob_inf"], dtype = float)
+    return state
+
+def write_node_state(G, state):
+    """
+    Write back the node state read by read_node_state in the network attributes
+    
+    Parameters
+    ----------
+    G: ig.Graph()
+        The contact network
+
+    state: dict
+        The node state, see read_node_state
+
+    Return
+    ------
+    None
+
+    """
+
+    G.vs["agent_status"] = np.array(STATUS_LABELS)[state["agent_status"]].tolist()
+    for attribute in NODE_STATE_ATTRIBUTES[1:]:
+        G.vs[attribute] = state[attribute].tolist()
+    if "prob_inf" in state:
+        G.vs["prob_inf"] = state["prob_inf"].tolist()
 
-def update_dump_report(to_dump, net, new_positive_counter, use_probabilities):
+def update_dump_report(to_dump, sim_index, net, new_positive_counter, use_probabilities):
     """
     Update the simulation dump in case light dump is selected
     
     Parameters
     ----------
     to_dump: dict
-        Old dump doctionary
+        Old dump doctionary, see init_dump_report
+
+    sim_index: int
+        Index of the step
 
     net: ig.Graph()
         The contact network
@@ -82,30 +253,26 @@ def update_dump_report(to_dump, net, new_positive_counter, use_probabilities):
 
     """
 
-    network_report = Counter(net.vs["agent_status"])
-    tested = 0
-    positive = 0
-    quarantined = 0
-    for node in net.vs:
-        if node["test_result"] != -1:
-            tested += 1
-        if node["test_result"] == 1:
-            positive += 1
-        if node["quarantine"] != 0:
-            quarantined += 1
-
-    to_dump['S'].append(network_report['S'])
-    to_dump['E'].append(network_report['E'])
-    to_dump['I'].append(network_report['I'])
-    to_dump['R'].append(network_report['R'])
-    to_dump['D'].append(network_report['D'])
-    to_dump['quarantined'].append(quarantined)
-    to_dump['positive'].append(positive)
-    to_dump['tested'].append(tested)
-    to_dump['new_positive_counter'].append(new_positive_counter)
+    # the series are full, double their size
+    if sim_index >= len(to_dump['S']):
+        size = max(2 * len(to_dump['S']), sim_index + 1)
+        for key in REPORT_SERIES:
+            to_dump[key] = np.resize(to_dump[key], size)
+        if use_probabilities:
+            to_dump['avg_prob_inf'] = np.resize(to_dump['avg_prob_inf'], size)
+
+    status_counts = np.bincount(encode_status(net.vs["agent_status"]), minlength = len(STATUS_LABELS))
+    test_result = np.array(net.vs["test_result"])
+
+    for code, label in enumerate(STATUS_LABELS):
+        to_dump[label][sim_index] = status_counts[code]
+    to_dump['quarantined'][sim_index] = np.count_nonzero(net.vs["quarantine"])
+    to_dump['positive'][sim_index] = np.count_nonzero(test_result == 1)
+    to_dump['tested'][sim_index] = np.count_nonzero(test_result != -1)
+    to_dump['new_positive_counter'][sim_index] = new_positive_counter
     if use_probabilities:
-        to_dump['avg_prob_inf'].append(np.mean(net.vs['prob_inf']))
-    to_dump['total'].append(sum(network_report.values()))
+        to_dump['avg_prob_inf'][sim_index] = np.mean(net.vs['prob_inf'])
+    to_dump['total'][sim_index] = net.vcount()
 
     return to_dump
 
@@ -137,40 +304,30 @@ def compute_sd_reduction(step_index, initial_day_restriction, restriction_durati
         
     """
     
-    default_days = restriction_duration // social_distance_strictness
-    spare_days = restriction_duration - default_days * social_distance_strictness
-
-    strictness_sequence = list()
-
-    for i in range(social_distance_strictness):
-        updated_days = default_days
-        if spare_days > 0:
-            updated_days += 1
-            spare_days -= 1
-        strictness_sequence.append(updated_days)
-
-
-    for i in range(1, len(strictness_sequence)):
-      strictness_sequence[i] += strictness_sequence[i - 1]
+    # the restriction is split in social_distance_strictness stages of default_days days,
+    # the first spare_days stages last one more day
+    default_days, spare_days = divmod(restriction_duration, social_distance_strictness)
+    elapsed_days = step_index - initial_day_restriction
 
-    social_distance_reduction = None
-
-    for i in range(len(strictness_sequence)):
-      if step_index - initial_day_restriction < strictness_sequence[i]:
-        social_distance_reduction = i
-        break
+    if elapsed_days < spare_days * (default_days + 1):
+        social_distance_reduction = elapsed_days // (default_days + 1)
+    else:
+        social_distance_reduction = spare_days + (elapsed_days - spare_days * (default_days + 1)) // default_days
 
     return social_distance_strictness - social_distance_reduction
 
-def perform_test(node, incubation_days, use_probabilities):
+def perform_test(state, nodes, incubation_days, use_probabilities):
     """
-    Perform tampon and syerological test on the node
+    Perform tampon and syerological test on the nodes
     
     Parameters
     ----------
+
+    state: dict
+        The node state, see read_node_state. It is updated in place
         
-    node: igraph.Vertex
-        Node to test
+    nodes: list of int
+        Nodes to test
 
     incubation_days: int
         Average number of days where the patient is not infective
@@ -180,26 +337,26 @@ def perform_test(node, incubation_days, use_probabilities):
 
     Return
     ------
-    positive: bool
-        If the node tested is found positive
+    positive: list of int
+        The tested nodes found positive
         
     """
 
-    if node["infected"]:
-        node["test_result"] = 1
-        node["quarantine"] = 14
-        node["test_validity"] = 14
-        if use_probabilities:
-            node["prob_inf"] = 1
-        return True
-    else:
-        node["test_result"] = 0
-        node["test_validity"] = incubation_days
-        if use_probabilities:
-            node["prob_inf"] = 0
-        return False
+    nodes = np.asarray(nodes, dtype = np.int64)
+    infected = state["infected"][nodes]
+    positive = nodes[infected]
+    negative = nodes[~infected]
 
-    return None
+    state["test_result"][positive] = 1
+    state["quarantine"][positive] = 14
+    state["test_validity"][positive] = 14
+    state["test_result"][negative] = 0
+    state["test_validity"][negative] = incubation_days
+    if use_probabilities:
+        state["prob_inf"][positive] = 1
+        state["prob_inf"][negative] = 0
+
+    return positive.tolist()
 
 def retrive_to_test_quarantine(nodes, values, n_new_test, reverse = True):
     """
@@ -208,7 +365,7 @@ def retrive_to_test_quarantine(nodes, values, n_new_test, reverse = True):
     Parameters
     ----------
 
-    nodes: list
+    nodes: list of int
         List of all nodes that needs a test
 
     values: list
@@ -223,16 +380,402 @@ def retrive_to_test_quarantine(nodes, values, n_new_test, reverse = True):
     Return
     ------
     selected: list
-        List of nodes that will be tested
+        List of nodes that will be tested, the first n_new_test nodes sorted by (value, node)
+
+    """
+
+    k = min(n_new_test, len(nodes))
+    if k <= 0:
+        return list()
+
+    sign = 1 if reverse else -1
+    keys = sign * np.asarray(values)
+    ties = sign * np.asarray(nodes)
+    # select in linear time the nodes with a key not lower than the k-th, only these are sorted
+    kth = np.partition(keys, len(keys) - k)[len(keys) - k]
+    candidates = np.flatnonzero(keys >= kth)
+    order = np.lexsort((ties[candidates], keys[candidates]))[::-1][:k]
+
+    return np.asarray(nodes)[candidates[order]].tolist()
+
+def snapshot_contacts(G):
+    """
+    Extract from the network the contacts used by contact tracing.
+    This is much lighter than a copy of the whole network
+    
+    Parameters
+    ----------
+
+    G: ig.Graph()
+        The contact network
+
+    Return
+    ------
+    contacts: dict
+        edges -> np.array of shape (number of edges, 2) with the endpoints of each edge, family contacts first
+        weights -> np.array with the weight of each edge
+        n_family -> number of family contacts, the first n_family edges
+
+    """
+
+    edges = np.array(G.get_edgelist(), dtype = np.int32).reshape(-1, 2)
+    weights = np.array(G.es["weight"], dtype = WEIGHT_DTYPE)
+    family = np.array(G.es["category"]) == "family_contacts"
+    # snapshots never change, partition the edges once so that contact tracing can slice them
+    order = np.argsort(~family, kind = "stable")
+
+    contacts = dict()
+    contacts["edges"] = edges[order]
+    contacts["weights"] = weights[order]
+    contacts["n_family"] = int(np.count_nonzero(family))
+
+    return contacts
+
+def compute_adjacency(G):
+    """
+    Build the weighted adjacency of the network in CSR form.
+    The contacts of node i are indices[indptr[i]:indptr[i + 1]], with weights
+    weights[indptr[i]:indptr[i + 1]]
+    
+    Parameters
+    ----------
+
+    G: ig.Graph()
+        The contact network
+
+    Return
+    ------
+    indptr: np.array
+        Offset of the contacts of each node
+
+    indices: np.array
+        Contacts of the nodes
+
+    weights: np.array
+        Weight of each contact
+
+    """
+
+    edges = np.array(G.get_edgelist(), dtype = np.int32).reshape(-1, 2)
+    weights = np.array(G.es["weight"], dtype = WEIGHT_DTYPE)
+    # each undirected edge appears in the adjacency of both endpoints
+    sources = np.concatenate((edges[:, 0], edges[:, 1]))
+    targets = np.concatenate((edges[:, 1], edges[:, 0]))
+    order = np.argsort(sources, kind = "stable")
+
+    indptr = np.zeros(G.vcount() + 1, dtype = np.int64)
+    np.cumsum(np.bincount(sources, minlength = G.vcount()), out = indptr[1:])
+
+    return indptr, targets[order], np.concatenate((weights, weights))[order]
+
+def compute_strength(adjacency):
+    """
+    Compute the weighted degree of each node from the adjacency in CSR form
+    
+    Parameters
+    ----------
+
+    adjacency: tuple of np.array
+        Adjacency of the network in CSR form, see compute_adjacency
+
+    Return
+    ------
+    strength: np.array of int
+        Sum of the weights of the contacts of each node
+
+    """
+
+    indptr, indices, weights = adjacency
+    cumulative = np.zeros(len(weights) + 1, dtype = np.int64)
+    np.cumsum(weights, out = cumulative[1:])
+    return cumulative[indptr[1:]] - cumulative[indptr[:-1]]
+
+def _pack_attribute(values):
+    """
+    Convert a list of attribute values in a NumPy array, when possible.
+    Strings are stored as a tuple (labels, codes)
+    
+    Parameters
+    ----------
+
+    values: list
+        Values of the attribute
+
+    Return
+    ------
+    packed: np.array, tuple or list
+        The packed values. Lists of non scalar values are returned as they are
+
+    """
+
+    if len(values) == 0 or isinstance(values[0], (list, tuple)):
+        return values
+    array = np.asarray(values)
+    if array.dtype.kind == "U":
+        labels, codes = np.unique(array, return_inverse = True)
+        return (labels.tolist(), codes.astype(np.int32))
+    if array.dtype.kind == "O":
+        return values
+    return array
+
+def _unpack_attribute(packed):
+    """
+    Inverse of _pack_attribute
+    
+    Parameters
+    ----------
+
+    packed: np.array, tuple or list
+        The packed values
+
+    Return
+    ------
+    values: list
+        Values of the attribute
+
+    """
+
+    if isinstance(packed, tuple):
+        labels, codes = packed
+        return [labels[code] for code in codes.tolist()]
+    if isinstance(packed, np.ndarray):
+        return packed.tolist()
+    return packed
+
+def pack_network(G):
+    """
+    Convert the network in a dict of NumPy arrays, that can be pickled
+    out-of-band by dump_record. Graph attributes starting with _ are not packed
+    
+    Parameters
+    ----------
+
+    G: ig.Graph()
+        The contact network
+
+    Return
+    ------
+    record: dict
+        The packed network
+
+    """
+
+    record = dict()
+    record["n"] = G.vcount()
+    record["edges"] = np.array(G.get_edgelist(), dtype = np.int32).reshape(-1, 2)
+    # private graph attributes are caches of the simulation, rebuilt when needed
+    record["graph"] = {name: G[name] for name in G.attributes() if not name.startswith("_")}
+    record["vertex"] = {name: _pack_attribute(G.vs[name]) for name in G.vs.attributes()}
+    record["edge"] = {name: _pack_attribute(G.es[name]) for name in G.es.attributes()}
+
+    return record
+
+def unpack_network(record):
+    """
+    Rebuild the network packed by pack_network
+    
+    Parameters
+    ----------
+
+    record: dict
+        The packed network
+
+    Return
+    ------
+    G: ig.Graph()
+        The contact network
+
+    """
+
+    G = ig.Graph(n = record["n"], edges = record["edges"].tolist())
+    for name, value in record["graph"].items():
+        G[name] = value
+    for name, packed in record["vertex"].items():
+        G.vs[name] = _unpack_attribute(packed)
+    for name, packed in record["edge"].items():
+        G.es[name] = _unpack_attribute(packed)
+
+    return G
+
+def dump_record(obj, f):
+    """
+    Write an object to an open file using pickle protocol 5.
+    Large buffers (NumPy arrays) are written out-of-band, right after a
+    length prefix, followed by the pickle stream
+    
+    Parameters
+    ----------
+
+    obj: object
+        The object to dump
+
+    f: file
+        File opened in binary write mode
+
+    Return
+    ------
+    None
+
+    """
+
+    buffers = list()
+    payload = pickle.dumps(obj, protocol = 5, buffer_callback = buffers.append)
+    f.write(len(buffers).to_bytes(8, "little"))
+    for buffer in buffers:
+        raw = buffer.raw()
+        f.write(raw.nbytes.to_bytes(8, "little"))
+        f.write(raw)
+    f.write(payload)
+
+def load_record(f):
+    """
+    Read an object written by dump_record
+    
+    Parameters
+    ----------
+
+    f: file
+        File opened in binary read mode
+
+    Return
+    ------
+    obj: object
+        The loaded object
+
+    """
+
+    header = f.read(8)
+    if len(header) < 8:
+        raise EOFError
+    buffers = list()
+    for i in range(int.from_bytes(header, "little")):
+        buffer = bytearray(int.from_bytes(f.read(8), "little"))
+        f.readinto(buffer)
+        buffers.append(buffer)
+
+    return pickle.load(f, buffers = buffers)
+
+def dump_file_path(path, compress = False):
+    """
+    Path of the dump file of a simulation
+    
+    Parameters
+    ----------
+
+    path: string
+        The path of the dump, without file type
+
+    compress: bool
+        If the dump is compressed with zstd
+
+    Return
+    ------
+    path: Path
+        The path of the dump, with file type
+
+    """
+
+    return Path(path + (".pickle.zst" if compress else ".pickle"))
+
+def open_dump(path, mode, compress = False):
+    """
+    Open the dump file of a simulation.
+    Compressed dumps are zstd streams, written using all the available cores.
+    Dumps are written to a temporary file with a unique name, so concurrent runs
+    on the same path do not clash; call finalize_dump with its path after closing it
+    to replace the previous dump
+    
+    Parameters
+    ----------
+
+    path: string
+        The path of the dump, without file type
+
+    mode: string
+        Either "wb" or "rb"
+
+    compress: bool
+        If the dump is compressed with zstd. Requires the zstandard package
+
+    Return
+    ------
+    f: file
+        The opened dump file
+
+    tmp_path: string
+        Only in "wb" mode, the path of the temporary file written
+
+    """
+
+    if mode == "rb":
+        f = open(dump_file_path(path, compress), mode)
+        if not compress:
+            return f
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+
+    dump_path = dump_file_path(path, compress)
+    # pid and a random suffix keep the writers apart, also threads of the same process
+    tmp_path = str(dump_path.with_name("{}.{}.{}.tmp".format(dump_path.name, os.getpid(), uuid.uuid4().hex[:8])))
+    # large writes, so a 1 MiB buffer instead of the default 8 KiB
+    f = open(tmp_path, "xb", buffering = 1 << 20)
+    if compress:
+        f = zstandard.ZstdCompressor(level = 3, threads = -1).stream_writer(f)
+    return f, tmp_path
+
+def finalize_dump(tmp_path, path, compress = False):
+    """
+    Move a dump written with open_dump to its final path.
+    The rename is atomic, so an interrupted simulation never leaves a truncated dump
+    nor destroys the dump of a previous run
+    
+    Parameters
+    ----------
+
+    tmp_path: string
+        The temporary file returned by open_dump
+
+    path: string
+        The path of the dump, without file type
+
+    compress: bool
+        If the dump is compressed with zstd
+
+    Return
+    ------
+    None
 
     """
 
-    selected = list()
+    os.replace(tmp_path, dump_file_path(path, compress))
+
+def load_dump(path):
+    """
+    Load a simulation dump produced by run_simulation.
+    In case of a full dump, the networks stored one per day after the
+    parameters are rebuilt and collected in the "nets" list
+    
+    Parameters
+    ----------
+
+    path: string
+        The path of the dump, without file type (as passed to run_simulation).
+        If path.pickle does not exist, the compressed dump path.pickle.zst is read
 
-    zipped_lists = zip(values, nodes)
-    sorted_pairs = sorted(zipped_lists, reverse = reverse)
-    tuples = zip(*sorted_pairs)
-    sorted_values, sorted_nodes = [list(tuple) for tuple in  tuples]
-    selected = sorted_nodes[:min(n_new_test, len(nodes))]
+    Return
+    ------
+    to_dump: dict
+        The simulation dump
 
-    return selected
\ No newline at end of file
+    """
+
+    with open_dump(path, "rb", not dump_file_path(path).exists()) as f:
+        to_dump = load_record(f)
+        if to_dump["parameters"]["dump_type"] == "full":
+            to_dump["nets"] = list()
+            while True:
+                try:
+                    to_dump["nets"].append(unpack_network(load_record(f)))
+                except EOFError:
+                    break
+
+    return to_dump
@@ -0,0 +1,74 @@
+from functools import lru_cache
+
+@lru_cache(maxsize = 128)
+def validate_parameters(n_of_families, use_steps, number_of_steps, incubation_days, infection_duration,
+    initial_day_restriction, restriction_duration, social_distance_strictness, restriction_decreasing,
+    n_initial_infected_nodes, R_0, n_test, policy_test, contact_tracing_efficiency, contact_tracing_duration,
+    quarantine_efficiency, use_fixed_seed, seed, use_probabilities, alpha, gamma, lambdaa, dump_type, path,
+    compress_dump, betweenness_cutoff = None):
+    """
+    Check the simulation parameters.
+    Results are cached, so repeated runs with the same configuration (e.g. a
+    sweep over seeds) are checked only once
+    
+    Parameters
+    ----------
+    See run_simulation
+
+    Return
+    ------
+    None
+
+    Raise
+    -----
+    ValueError
+        If a parameter has an invalid value
+
+    """
+
+    if n_of_families < 10:
+        raise ValueError("Invalid number of families. Use at least 10 families")
+    if use_steps:
+        if number_of_steps < 0:
+            raise ValueError("Invalid number of steps")
+    if infection_duration < 0:
+        raise ValueError("Invalid infection duration")
+    if incubation_days < 0 or incubation_days >= infection_duration:
+        raise ValueError("Invalid incubation duration")
+    if initial_day_restriction < 0 :
+        raise ValueError("Invalid initial day social distancing")
+    if social_distance_strictness < 0 or social_distance_strictness > 4:
+        raise ValueError("Invalid social distancing value")
+    if n_initial_infected_nodes < 0 or n_initial_infected_nodes > n_of_families:
+        raise ValueError("Invalid number of initial infected nodes")
+    if R_0 < 0:
+        raise ValueError("Invalid value of R0")
+    if n_test < 0:
+        raise ValueError("Invalid number of test per day")
+    if policy_test not in ("Random", "Degree Centrality", "Betweenness Centrality", "PBI"):
+        raise ValueError("Invalid test strategy")
+    if contact_tracing_efficiency < 0 or contact_tracing_efficiency > 1:
+        raise ValueError("Invalid contact tracing efficiency")
+    if quarantine_efficiency < 0 or quarantine_efficiency > 1:
+        raise ValueError("Invalid quarantine efficiency")
+    if contact_tracing_duration < 0:
+        raise ValueError("Invalid contact tracing duration")
+    if restriction_duration < 0:
+        raise ValueError("Invalid restriction duration")
+    if gamma < 0 :
+        raise ValueError("Value of gamma must greater than 0")
+    if lambdaa < 0 or lambdaa > 1:
+        raise ValueError("Value of lambda must be 0 < lambda < 1")
+    if dump_type != "full" and dump_type != "light":
+        raise ValueError("Invalid dump type")
+    if path == None:
+        raise ValueError("Invalid path")
+    if betweenness_cutoff is not None and betweenness_cutoff <= 0:
+        raise ValueError("Invalid betweenness cutoff")
+    if not use_probabilities and policy_test == "PBI":
+        raise ValueError("Cannot use PBI if probability of being infected is not enabled")
+    if compress_dump:
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ValueError("Compressed dumps require the zstandard package")
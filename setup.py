@@ -20,6 +20,8 @@ setup(
   author = 'Matteo Mistri, Diego Miglio',
   author_email = 'matteo.mistri1996@gmail.com',
   install_requires = required,
+  extras_require = {'zstd': ['zstandard']},
+  python_requires = '>=3.8',
   version = ver,
   url = "https://gitlab.com/mistrello96/ctns",
   download_url='https://pypi.org/project/ctns/',